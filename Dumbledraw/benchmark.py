@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+import collections
+logger = logging.getLogger(__name__)
+
+# Benchmarks of the Dumbledraw pipeline on synthetic shapes files. Each
+# benchmark runs in a fresh process, so that its peak RSS is not affected by
+# the other benchmarks, and reports the wall time of the benchmarked calls.
+# The results are written to a JSON file for comparisons between runs.
+
+# size of the synthetic shapes files
+Scale = collections.namedtuple(
+    "Scale", ["channels", "categories", "processes", "bins", "systematics"])
+
+_era = "Run2016"
+_analysis = "smhtt"
+_variable = "m_vis"
+_mass = 125
+_layouts = ["standard", "CombineHarvester", "inputshapes"]
+_script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+
+
+def channel_names(scale):
+    return ["ch%d" % i for i in range(scale.channels)]
+
+
+def category_names(scale):
+    return ["cat%d" % i for i in range(scale.categories)]
+
+
+def process_names(scale):
+    return ["proc%d" % i for i in range(scale.processes)]
+
+
+def systematic_names(scale):
+    return ["syst%d" % i for i in range(scale.systematics)]
+
+
+def shapes_filename(workdir, layout):
+    return os.path.join(workdir, "shapes_%s.root" % layout)
+
+
+def _make_hist(name, nbins, rng, scale=1.0):
+    import ROOT as R
+    hist = R.TH1F(name, name, nbins, 0.0, float(nbins))
+    hist.Sumw2()
+    for i in range(1, nbins + 1):
+        value = scale * rng.uniform(10.0, 1000.0)
+        hist.SetBinContent(i, value)
+        hist.SetBinError(i, value**0.5)
+    return hist
+
+
+# writes the histograms of all channels, categories, processes and
+# systematic variations in the given layout
+def generate(filename, layout, scale, seed=1):
+    import ROOT as R
+    rng = random.Random(seed)
+    rootfile = R.TFile(filename, "RECREATE")
+    names = ["data_obs"] + process_names(scale)
+    for channel in channel_names(scale):
+        for category in category_names(scale):
+            if layout == "standard":
+                directory = rootfile.mkdir("%s_%s" % (channel, category))
+            elif layout == "CombineHarvester":
+                directory = rootfile.mkdir("htt_%s_%s_%s" %
+                                           (channel, category, _era))
+            elif layout == "inputshapes":
+                directory = rootfile
+            else:
+                logger.fatal("Unknown layout %s of shapes file!" % layout)
+                raise Exception
+            directory.cd()
+            for process in names:
+                if layout == "inputshapes":
+                    name = "#{}#{}#{}#{}#{}#{}#{}#".format(
+                        channel, category, process, _analysis, _era,
+                        _variable, _mass)
+                else:
+                    name = process
+                hist = _make_hist(name, scale.bins, rng)
+                hist.Write()
+                if layout == "inputshapes" or process == "data_obs":
+                    continue
+                for syst in systematic_names(scale):
+                    for shift, factor in [("Up", 1.1), ("Down", 0.9)]:
+                        hist = _make_hist("%s_%s%s" % (process, syst, shift),
+                                          scale.bins, rng, factor)
+                        hist.Write()
+    rootfile.Close()
+
+
+# yields the channel, category and histograms of the standard layout
+def _iterate_histograms(workdir, scale):
+    import rootfile_parser
+    parser = rootfile_parser.Rootfile_parser(
+        shapes_filename(workdir, "standard"), "standard")
+    for channel in channel_names(scale):
+        for category in category_names(scale):
+            hists = [(process, parser.get(_era, channel, category, process))
+                     for process in process_names(scale)]
+            data = parser.get(_era, channel, category, "data_obs")
+            yield channel, category, hists, data
+
+
+# Each benchmark returns the wall time spent in the benchmarked calls and the
+# number of these calls. Reading the inputs and setting up plots are not
+# included, except for the parser benchmarks.
+
+
+def bench_get_standard(workdir, scale):
+    return _bench_get(workdir, scale, "standard")
+
+
+def bench_get_combineharvester(workdir, scale):
+    return _bench_get(workdir, scale, "CombineHarvester")
+
+
+def _bench_get(workdir, scale, layout):
+    import rootfile_parser
+    start = time.time()
+    parser = rootfile_parser.Rootfile_parser(
+        shapes_filename(workdir, layout), layout)
+    ncalls = 0
+    for channel in channel_names(scale):
+        for category in category_names(scale):
+            for process in process_names(scale):
+                parser.get(_era, channel, category, process)
+                ncalls += 1
+                for syst in systematic_names(scale):
+                    for shift in ["Up", "Down"]:
+                        parser.get(_era, channel, category, process,
+                                   syst + shift)
+                        ncalls += 1
+    return time.time() - start, ncalls
+
+
+def bench_get_inputshapes(workdir, scale):
+    import rootfile_parser_inputshapes
+    start = time.time()
+    parser = rootfile_parser_inputshapes.Rootfile_parser(
+        shapes_filename(workdir, "inputshapes"), _analysis, _era, _variable,
+        _mass)
+    ncalls = 0
+    for channel in channel_names(scale):
+        for category in category_names(scale):
+            for process in process_names(scale):
+                parser.get(channel, category, process)
+                ncalls += 1
+    return time.time() - start, ncalls
+
+
+def bench_get_values(workdir, scale):
+    import rootfile_parser
+    start = time.time()
+    parser = rootfile_parser.Rootfile_parser(
+        shapes_filename(workdir, "standard"), "standard")
+    ncalls = 0
+    for channel in channel_names(scale):
+        for category in category_names(scale):
+            for process in process_names(scale):
+                parser.get_values(_era, channel, category, process)
+                ncalls += 1
+    return time.time() - start, ncalls
+
+
+# creates the plot template of the plot benchmarks, an upper panel and a
+# ratio panel, which is cleared for each category
+def _template():
+    import dumbledraw as dd
+    return dd.Plot([0.3], "ModTDR", r=0.04, l=0.14)
+
+
+def _fill(plot, hists, data):
+    for process, hist in hists:
+        plot.add_hist(hist, process, "bkg")
+    plot.add_hist(data, "data_obs", "data_obs")
+
+
+def bench_add_hist(workdir, scale):
+    plot = _template()
+    elapsed = 0.0
+    ncalls = 0
+    for channel, category, hists, data in _iterate_histograms(workdir, scale):
+        plot.clear_hists()
+        start = time.time()
+        _fill(plot, hists, data)
+        elapsed += time.time() - start
+        ncalls += len(hists) + 1
+    return elapsed, ncalls
+
+
+def bench_create_stack(workdir, scale):
+    plot = _template()
+    elapsed = 0.0
+    ncalls = 0
+    for channel, category, hists, data in _iterate_histograms(workdir, scale):
+        plot.clear_hists()
+        _fill(plot, hists, data)
+        start = time.time()
+        plot.create_stack([process for process, hist in hists], "stack")
+        elapsed += time.time() - start
+        ncalls += 1
+    return elapsed, ncalls
+
+
+def bench_normalize(workdir, scale):
+    plot = _template()
+    elapsed = 0.0
+    ncalls = 0
+    for channel, category, hists, data in _iterate_histograms(workdir, scale):
+        plot.clear_hists()
+        _fill(plot, hists, data)
+        start = time.time()
+        plot.subplot(1).normalize(["data_obs", "bkg"], "bkg")
+        elapsed += time.time() - start
+        ncalls += 1
+    return elapsed, ncalls
+
+
+def bench_draw_unrolled(workdir, scale):
+    plot = _template()
+    plot.unroll(["bin %d" % i for i in range(4)])
+    elapsed = 0.0
+    ncalls = 0
+    for channel, category, hists, data in _iterate_histograms(workdir, scale):
+        plot.clear_hists()
+        _fill(plot, hists, data)
+        plot.create_stack([process for process, hist in hists], "stack")
+        start = time.time()
+        plot.subplot(0).Draw(["stack", "data_obs"])
+        elapsed += time.time() - start
+        ncalls += 1
+    return elapsed, ncalls
+
+
+def bench_save(workdir, scale):
+    plot = _template()
+    outputdir = os.path.join(workdir, "plots")
+    if not os.path.exists(outputdir):
+        os.makedirs(outputdir)
+    elapsed = 0.0
+    ncalls = 0
+    for channel, category, hists, data in _iterate_histograms(workdir, scale):
+        plot.clear_hists()
+        _fill(plot, hists, data)
+        plot.create_stack([process for process, hist in hists], "stack")
+        plot.subplot(0).Draw(["stack", "data_obs"])
+        plot.subplot(1).normalize(["data_obs", "bkg"], "bkg")
+        plot.subplot(1).Draw(["bkg", "data_obs"])
+        start = time.time()
+        plot.save(
+            os.path.join(outputdir, "%s_%s" % (channel, category)),
+            formats=["png", "pdf"])
+        elapsed += time.time() - start
+        ncalls += 1
+    return elapsed, ncalls
+
+
+benchmarks = collections.OrderedDict([
+    ("get_standard", bench_get_standard),
+    ("get_combineharvester", bench_get_combineharvester),
+    ("get_inputshapes", bench_get_inputshapes),
+    ("get_values", bench_get_values),
+    ("add_hist", bench_add_hist),
+    ("create_stack", bench_create_stack),
+    ("normalize", bench_normalize),
+    ("draw_unrolled", bench_draw_unrolled),
+    ("save", bench_save),
+])
+
+
+# peak resident set size of this process in MB, ru_maxrss is given in kB
+# on Linux
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# runs a single benchmark in this process and writes its result to a file
+def run_single(name, workdir, scale, resultfile):
+    import ROOT as R
+    R.gROOT.SetBatch(True)
+    R.gErrorIgnoreLevel = R.kWarning
+    elapsed, ncalls = benchmarks[name](workdir, scale)
+    with open(resultfile, "w") as f:
+        json.dump({
+            "wall_s": elapsed,
+            "calls": ncalls,
+            "peak_rss_mb": peak_rss()
+        }, f)
+
+
+def _scale_arguments(scale):
+    return [
+        "--channels", str(scale.channels), "--categories",
+        str(scale.categories), "--processes", str(scale.processes), "--bins",
+        str(scale.bins), "--systematics", str(scale.systematics)
+    ]
+
+
+# Generates the shapes files in all layouts and runs each benchmark repeat
+# times in a new process. Returns the results as dict.
+def run(scale, names=None, repeat=3, workdir=None):
+    if names == None:
+        names = list(benchmarks.keys())
+    for name in names:
+        if not name in benchmarks:
+            logger.fatal("Unknown benchmark %s!" % name)
+            raise Exception
+    remove_workdir = workdir == None
+    if workdir == None:
+        workdir = tempfile.mkdtemp(prefix="dumbledraw_benchmark_")
+    try:
+        start = time.time()
+        for layout in _layouts:
+            generate(shapes_filename(workdir, layout), layout, scale)
+        logger.info("Generated shapes files in %s in %.2f s" %
+                    (workdir, time.time() - start))
+        results = collections.OrderedDict()
+        for name in names:
+            runs = []
+            for i in range(repeat):
+                resultfile = os.path.join(workdir, "result_%s.json" % name)
+                subprocess.check_call(
+                    [sys.executable, _script, "--run", name,
+                     "--workdir", workdir, "--result", resultfile] +
+                    _scale_arguments(scale))
+                with open(resultfile) as f:
+                    runs.append(json.load(f))
+            wall = [result["wall_s"] for result in runs]
+            results[name] = {
+                "calls": runs[0]["calls"],
+                "wall_s": wall,
+                "min_wall_s": min(wall),
+                "mean_wall_s": sum(wall) / len(wall),
+                "peak_rss_mb": max([result["peak_rss_mb"] for result in runs])
+            }
+            logger.info("%-22s %8d calls %10.4f s (min) %10.1f MB peak RSS" %
+                        (name, results[name]["calls"],
+                         results[name]["min_wall_s"],
+                         results[name]["peak_rss_mb"]))
+    finally:
+        if remove_workdir:
+            shutil.rmtree(workdir)
+    return collections.OrderedDict([
+        ("created", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("host", platform.node()),
+        ("platform", platform.platform()),
+        ("python", platform.python_version()),
+        ("scale", scale._asdict()),
+        ("repeat", repeat),
+        ("benchmarks", results),
+    ])
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark Dumbledraw on synthetic shapes files.")
+    parser.add_argument(
+        "--output",
+        default="dumbledraw_benchmark.json",
+        type=str,
+        help="Output JSON file with the results.")
+    parser.add_argument(
+        "--benchmarks",
+        default=None,
+        nargs="+",
+        choices=list(benchmarks.keys()),
+        help="Benchmarks to be run, defaults to all.")
+    parser.add_argument(
+        "--repeat",
+        default=3,
+        type=int,
+        help="Number of runs per benchmark.")
+    parser.add_argument("--channels", default=3, type=int)
+    parser.add_argument("--categories", default=10, type=int)
+    parser.add_argument("--processes", default=10, type=int)
+    parser.add_argument("--bins", default=40, type=int)
+    parser.add_argument("--systematics", default=5, type=int)
+    parser.add_argument(
+        "--workdir",
+        default=None,
+        type=str,
+        help="Directory for the shapes files, defaults to a temporary directory.")
+    parser.add_argument(
+        "--run", default=None, type=str, help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--result", default=None, type=str, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_arguments()
+    scale = Scale(args.channels, args.categories, args.processes, args.bins,
+                  args.systematics)
+    if args.run != None:
+        run_single(args.run, args.workdir, scale, args.result)
+    else:
+        results = run(scale, args.benchmarks, args.repeat, args.workdir)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info("Created %s" % args.output)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import traceback
+import functools
+import threading
+import collections
+import multiprocessing
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import ROOT as R
+import profiling
+import tfile_pool
+logger = logging.getLogger(__name__)
+
+# outcome of a single plot task, value holds the return value of the task
+# function, error the formatted traceback on failure and profile the
+# profiling data of the task if profiling is enabled
+TaskResult = collections.namedtuple(
+    "TaskResult", ["task", "success", "duration", "error", "value", "profile"])
+
+
+def _run_task(function_task):
+    function, task = function_task
+    start = time.time()
+    try:
+        with profiling.plot_scope(task):
+            value = function(task)
+    except Exception:
+        return TaskResult(task, False, time.time() - start,
+                          traceback.format_exc(), None, _collect_profile())
+    return TaskResult(task, True, time.time() - start, None, value,
+                      _collect_profile())
+
+
+def _call_with_inputs(function, inputs, task):
+    return function(task, inputs)
+
+
+# picklable function(task) reading the inputs of a task in the worker process
+class _ReadAndRun(object):
+    def __init__(self, function, prefetch):
+        self._function = function
+        self._prefetch = prefetch
+
+    def __call__(self, task):
+        return self._function(task, self._prefetch(task))
+
+
+def _collect_profile():
+    if profiling.is_enabled():
+        return profiling.collect()
+    return None
+
+
+# Makes all ROOT objects in the fetched inputs, also inside dicts, lists and
+# tuples, owned by Python. Histograms are removed from the directories of
+# the files of the prefetch thread, which may be closed before the inputs
+# are used, and are freed with the inputs instead of piling up in the files.
+def _detach(value):
+    if isinstance(value, dict):
+        for item in value.values():
+            _detach(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _detach(item)
+    elif isinstance(value, R.TObject):
+        if value.InheritsFrom("TH1"):
+            value.SetDirectory(0)
+        R.SetOwnership(value, True)
+    return value
+
+
+# Iterates over (task, inputs, error) of the given tasks, where the inputs
+# = fetch(task) are read ahead in a background thread while the caller
+# processes the previous tasks, e.g. reading the histograms of the next plots
+# while the current one is drawn and saved. At most depth fetched inputs are
+# queued, which bounds the memory. The thread opens its own TFile handles
+# (see tfile_pool.use_private_pool) and calls the initializer once before the
+# first fetch, so parsers must be created in the thread and not be shared
+# with the caller. ROOT objects in the inputs are detached from the files of
+# the thread before they are queued. If fetch fails, inputs is None and error
+# holds the formatted traceback.
+class Prefetcher(object):
+    _done = object()  # marks the end of the tasks in the queue
+
+    def __init__(self, fetch, tasks, depth=2, initializer=None, initargs=()):
+        if not isinstance(depth, int) or depth < 1:
+            logger.fatal("Prefetch depth must be a positive int!")
+            raise Exception
+        self._fetch = fetch
+        self._tasks = list(tasks)
+        self._initializer = initializer
+        self._initargs = initargs
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __iter__(self):
+        if self._thread == None:
+            R.ROOT.EnableThreadSafety()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        while True:
+            item = self._queue.get()
+            if item is Prefetcher._done:
+                break
+            yield item
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _run(self):
+        tfile_pool.use_private_pool()
+        error = None
+        if self._initializer != None:
+            try:
+                self._initializer(*self._initargs)
+            except Exception:
+                error = traceback.format_exc()
+        for task in self._tasks:
+            if error != None:
+                item = (task, None, error)
+            else:
+                try:
+                    with profiling.plot_scope(task, timed=False), \
+                            profiling.phase("prefetch"):
+                        item = (task, _detach(self._fetch(task)), None)
+                except Exception:
+                    item = (task, None, traceback.format_exc())
+            if not self._put(item):
+                return
+        self._put(Prefetcher._done)
+
+    # blocks while the queue is full, returns False if stopped by close
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # stops reading ahead, e.g. if the caller does not process all tasks
+    def close(self):
+        self._stop.set()
+        if self._thread != None:
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._thread = None
+
+
+# Runs function(task) for all tasks and returns a list of TaskResults in the
+# order of completion. With jobs > 1 the tasks are distributed over a process
+# pool, since the global gPad/gStyle state of ROOT does not allow threads.
+# The initializer is called once per worker process, e.g. to set up batch mode
+# and styles or to open the input files. If profiling is enabled, the
+# profiles of all tasks are merged in the calling process.
+# With a prefetch function, function(task, prefetch(task)) is called instead.
+# The inputs of the next depth tasks are then read by a Prefetcher while the
+# current task runs. With jobs > 1 each worker reads the inputs of its own
+# tasks, reading and drawing overlap between the worker processes.
+def run_campaign(function,
+                 tasks,
+                 jobs=1,
+                 initializer=None,
+                 initargs=(),
+                 prefetch=None,
+                 depth=2):
+    tasks = list(tasks)
+    results = []
+    if jobs <= 1:
+        if initializer != None:
+            initializer(*initargs)
+        if prefetch != None:
+            with Prefetcher(prefetch, tasks, depth) as prefetcher:
+                for task, inputs, error in prefetcher:
+                    if error != None:
+                        results.append(
+                            TaskResult(task, False, 0.0, error, None, None))
+                    else:
+                        results.append(
+                            _run_task((functools.partial(
+                                _call_with_inputs, function, inputs), task)))
+                    _merge_profile(results[-1])
+                    _log_result(results[-1], len(results), len(tasks))
+            return results
+        for task in tasks:
+            results.append(_run_task((function, task)))
+            _merge_profile(results[-1])
+            _log_result(results[-1], len(results), len(tasks))
+        return results
+    if prefetch != None:
+        function = _ReadAndRun(function, prefetch)
+    pool = multiprocessing.Pool(jobs, initializer, initargs)
+    try:
+        for result in pool.imap_unordered(
+                _run_task, [(function, task) for task in tasks]):
+            results.append(result)
+            _merge_profile(result)
+            _log_result(result, len(results), len(tasks))
+    except BaseException:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+    return results
+
+
+def _merge_profile(result):
+    if result.profile != None:
+        profiling.merge(result.profile)
+
+
+def _log_result(result, ndone, ntasks):
+    if result.success:
+        logger.info("[%d/%d] Finished %s in %.2f s" %
+                    (ndone, ntasks, result.task, result.duration))
+    else:
+        logger.error("[%d/%d] Failed %s after %.2f s:\n%s" %
+                     (ndone, ntasks, result.task, result.duration,
+                      result.error))
+
+
+def log_summary(results):
+    failed = [result for result in results if not result.success]
+    total = sum([result.duration for result in results])
+    logger.info("Campaign summary: %d tasks, %d succeeded, %d failed, %.2f s summed task time" %
+                (len(results), len(results) - len(failed), len(failed), total))
+    for result in failed:
+        logger.info("  failed: %s" % (result.task, ))
+    return len(failed) == 0
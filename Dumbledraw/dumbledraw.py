@@ -6,21 +6,188 @@ import logging
 import copy
 import ROOT as R
 import math
+import os
+import atexit
+import hashlib
+import threading
+import types
+import functools
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 #import rootfile_parser
 logger = logging.getLogger(__name__)
 
 import styles
+import hist_arrays
+import profiling
+import rebinning
+import numpy as np
+
+# formats which are written from a single image of the painted canvas
+raster_formats = ["png", "jpg", "jpeg", "gif", "bmp", "tif", "tiff", "xpm"]
+
+
+# Writes images of painted canvases to disk in a background thread. Only the
+# encoding and writing of raster images is done in the thread, painting stays
+# in the main thread due to the global gPad state.
+class ImageWriter(object):
+    def __init__(self, maxsize=8):
+        self._queue = queue.Queue(maxsize)  # bounds the images held in memory
+        self._thread = None
+
+    def submit(self, image, outputname):
+        if self._thread == None:
+            R.ROOT.EnableThreadSafety()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put((image, outputname))
+
+    def _run(self):
+        while True:
+            image, outputname = self._queue.get()
+            try:
+                image.WriteImage(outputname)
+                logger.info("Created %s" % outputname)
+            except Exception as e:
+                logger.error("Failed to write %s: %s" % (outputname, e))
+            finally:
+                del image  # the last reference of the last output deletes it
+                self._queue.task_done()
+
+    def wait(self):
+        self._queue.join()
+
+
+_image_writer = ImageWriter()
+atexit.register(_image_writer.wait)
+
+
+# blocks until all images saved with Plot.save(..., background=True) are written
+def wait_for_saves():
+    _image_writer.wait()
+
+
+# copies a histogram or graph. Histograms are detached from the current
+# directory, e.g. an open input file, so that the copies are only owned by
+# Python and not deleted when the file is closed.
+def _copy(obj):
+    obj = copy.deepcopy(obj)
+    if obj.InheritsFrom("TH1"):
+        obj.SetDirectory(0)
+    return obj
+
+
+# Handle of a histogram which is read only when a subplot needs it, e.g. for
+# drawing, stacking or normalizing, instead of when it is added to the plot:
+#   plot.add_hist(LazyHist(rootfile.get, "mt", "inclusive", "ZTT"), "ZTT")
+# The function is called at most once and its result is shared by all
+# subplots the handle is added to, which copy it when reading it. Histograms
+# which are not needed by any subplot are never read.
+class LazyHist(object):
+    def __init__(self, function, *args, **kwargs):
+        self._function = function
+        self._args = args
+        self._kwargs = kwargs
+        self._hist = None
+        self._read = False
 
-
+    @property
+    def is_read(self):
+        return self._read
+
+    def get(self):
+        if not self._read:
+            self._hist = self._function(*self._args, **self._kwargs)
+            self._read = True
+        return self._hist
+
+
+# Python functions returning a histogram, which are wrapped in a LazyHist.
+# Other callables, e.g. a TF1, are rejected by the type check of add_hist.
+def _is_function(obj):
+    return isinstance(obj, (types.FunctionType, types.MethodType,
+                            types.BuiltinFunctionType, functools.partial))
+
+
+# adds the repr of a value to a hash, used for the fingerprints of plots
+def _update_digest(digest, value):
+    text = repr(value)
+    if not isinstance(text, bytes):
+        text = text.encode("utf-8")
+    digest.update(text)
+
+
+def _update_hist_digest(digest, hist):
+    for array in hist_arrays.get_arrays(hist, flow=True):
+        digest.update(array.tobytes())
+    _update_digest(digest, (hist.GetLineColor(), hist.GetLineStyle(),
+                            hist.GetLineWidth(), hist.GetFillColor(),
+                            hist.GetFillStyle(), hist.GetMarkerColor(),
+                            hist.GetMarkerStyle(), hist.GetMarkerSize()))
+
+
+# error buffers of the supported graph types
+_graph_error_getters = [
+    ("TGraphAsymmErrors", ["GetEXlow", "GetEXhigh", "GetEYlow", "GetEYhigh"]),
+    ("TGraphErrors", ["GetEX", "GetEY"]),
+]
+
+
+def _update_graph_digest(digest, graph):
+    n = graph.GetN()
+    getters = ["GetX", "GetY"]
+    for classname, error_getters in _graph_error_getters:
+        if graph.InheritsFrom(classname):
+            getters += error_getters
+            break
+    for getter in getters:
+        if n > 0:
+            digest.update(
+                np.frombuffer(getattr(graph, getter)(), dtype=np.float64,
+                              count=n).tobytes())
+    _update_digest(digest, (n, graph.GetLineColor(), graph.GetLineStyle(),
+                            graph.GetLineWidth(), graph.GetFillColor(),
+                            graph.GetFillStyle(), graph.GetMarkerColor(),
+                            graph.GetMarkerStyle(), graph.GetMarkerSize()))
+
+
+# With backend="matplotlib" the plot is rendered from the histogram arrays
+# with the Agg backend of matplotlib instead of a TCanvas. No pads are
+# created and gPad is not used, so that plots can be saved in parallel
+# threads. The canvas size and margins are taken from the width, height, l,
+# r, t and b arguments of the ModTDR style.
 class Plot(object):
-    def __init__(self, splitlist, style="none", **kwargs):
-        styles.SetStyle(style, **kwargs)
-        R.gROOT.SetBatch(True)  # don't disply canvas
-        self._canvas = R.TCanvas()
-        self._canvas.cd()
+    def __init__(self, splitlist, style="none", backend="root", **kwargs):
+        if not backend in ["root", "matplotlib"]:
+            logger.fatal("Unknown backend %s!" % backend)
+            raise Exception
+        self._backend = backend
+        self._closed = False
+        if backend == "root":
+            styles.SetStyle(style, **kwargs)
+            R.gROOT.SetBatch(True)  # don't disply canvas
+            self._canvas = R.TCanvas()
+            self._canvas.cd()
+            margins = None
+        else:
+            self._canvas = None
+            self._size = (kwargs.get("width", 600), kwargs.get("height", 600))
+            margins = [
+                kwargs.get("l", 0.16),
+                kwargs.get("r", 0.04),
+                kwargs.get("t", 0.06),
+                kwargs.get("b", 0.12)
+            ]
         self._subplots = []
         self._legends = []
         self._lines = []
+        self._shared_copies = {}  # id -> copies shared by all subplots
+        # arguments and drawn labels entering the fingerprint of the plot
+        self._init_args = (splitlist, style, backend, sorted(kwargs.items()))
+        self._annotations = []
         # evaluate splitlist and book
         if isinstance(splitlist, basestring):
             splitlist = [splitlist]
@@ -35,13 +202,39 @@ class Plot(object):
             if not isinstance(lower, float):
                 logger.fatal("Panel split is supposed to be of type float!")
                 raise Exception
-            self._subplots.append(Subplot(i, lower, upper))
+            self._subplots.append(Subplot(i, lower, upper, margins))
             upper = split
             if not isinstance(upper, float):
                 logger.fatal("Panel split is supposed to be of type float!")
                 raise Exception
         lower = 0.0
-        self._subplots.append(Subplot(len(splitlist), lower, upper))
+        self._subplots.append(Subplot(len(splitlist), lower, upper, margins))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    # Releases the ROOT objects of the plot in an order which leaves no
+    # dangling references: drawn primitives, registered histograms and
+    # unrolled pads first, then legends and lines, the pads and finally the
+    # canvas, which is removed from the global list of canvases. The plot
+    # cannot be used afterwards.
+    def close(self):
+        if self._closed:
+            return
+        self.clear_hists()
+        self._legends = []
+        self._lines = []
+        self._subplots = []
+        if self._canvas != None:
+            self._canvas.Clear()
+            self._canvas.Close()
+            R.gROOT.GetListOfCanvases().Remove(self._canvas)
+            self._canvas = None
+        self._closed = True
 
     @property
     def nsubplots(self):
@@ -78,11 +271,111 @@ class Plot(object):
             raise Exception
         return self._lines[index]
 
-    def save(self, outputname):
-        self._canvas.SaveAs(outputname)
-        logger.info("Created %s" % outputname)
+    # Saves the canvas. With a list of formats, e.g. ["pdf", "png", "root"],
+    # the outputs are written to outputname.<format>, where all raster
+    # formats are written from a single painted image. ROOT cannot reuse this
+    # image for vector formats, each of them (e.g. pdf, svg, eps) still
+    # repaints the canvas with SaveAs. With background=True the raster
+    # images are encoded and written by a background thread (not used by the
+    # matplotlib backend).
+    # With incremental=True the fingerprint of the plot is stored in
+    # outputname.fingerprint and painting and writing are skipped if all
+    # outputs exist with a matching fingerprint. Returns whether the outputs
+    # have been written.
+    @profiling.timed("save")
+    def save(self, outputname, formats=None, background=False,
+             incremental=False):
+        if self._closed:
+            logger.fatal("Plot has already been closed!")
+            raise Exception
+        outputnames = self._outputnames(outputname, formats)
+        if incremental:
+            fingerprint = self.fingerprint()
+            if not self._needs_update(outputname, outputnames, fingerprint):
+                logger.info("Skipped %s, outputs are up to date" % outputname)
+                return False
+            if os.path.exists(outputname + ".fingerprint"):
+                os.remove(outputname + ".fingerprint")
+        if self._backend == "matplotlib":
+            import mpl_backend
+            mpl_backend.save(self, outputnames)
+        else:
+            self._save_root(outputnames, formats == None and not background,
+                            background)
+        if incremental:
+            with open(outputname + ".fingerprint", "w") as f:
+                f.write(fingerprint + "\n")
+        return True
+
+    def _save_root(self, outputnames, single_output, background):
+        raster_outputs = [
+            name for name in outputnames
+            if name.split(".")[-1].lower() in raster_formats
+        ]
+        if single_output:
+            raster_outputs = []  # single output, let ROOT handle it
+        if len(raster_outputs) != 0:
+            with profiling.phase("save.paint"):
+                self._canvas.Modified()
+                self._canvas.Update()
+                image = R.TImage.Create()
+                R.SetOwnership(image, True)  # deleted after the last write
+                image.FromPad(self._canvas)
+            for name in raster_outputs:
+                if background:
+                    _image_writer.submit(image, name)
+                else:
+                    with profiling.phase("save.write"):
+                        image.WriteImage(name)
+                    logger.info("Created %s" % name)
+        for name in outputnames:
+            if not name in raster_outputs:
+                with profiling.phase("save.SaveAs"):
+                    self._canvas.SaveAs(name)
+                logger.info("Created %s" % name)
+
+    def _outputnames(self, outputname, formats):
+        if formats == None:
+            return [outputname]
+        return ["%s.%s" % (outputname, fmt.lstrip(".")) for fmt in formats]
+
+    def _needs_update(self, outputname, outputnames, fingerprint):
+        for name in outputnames:
+            if not os.path.exists(name):
+                return True
+        if not os.path.exists(outputname + ".fingerprint"):
+            return True
+        with open(outputname + ".fingerprint") as f:
+            return f.read().strip() != fingerprint
+
+    # returns whether save(outputname, formats, incremental=True) would
+    # write the outputs, e.g. for dry runs
+    def needs_update(self, outputname, formats=None):
+        return self._needs_update(outputname,
+                                  self._outputnames(outputname, formats),
+                                  self.fingerprint())
+
+    # hash of everything registered in the plot that determines the output:
+    # histograms and graphs with their styles, axis settings, drawn objects,
+    # legends, lines and labels. Direct modifications of the ROOT pads are
+    # not included.
+    def fingerprint(self):
+        digest = hashlib.sha1()
+        _update_digest(digest, self._init_args)
+        _update_digest(digest, self._annotations)
+        for subplot in self._subplots:
+            subplot._update_fingerprint(digest)
+        for legend in self._legends:
+            legend._update_fingerprint(digest)
+        for line in self._lines:
+            line._update_fingerprint(digest)
+        return digest.hexdigest()
 
     def DrawChannelCategoryLabel(self, text, textsize=0.04, begin_left=None, print_inside=False):
+        self._annotations.append(("DrawChannelCategoryLabel", text, textsize,
+                                  begin_left, print_inside))
+        if self._canvas == None:
+            return  # drawn by the matplotlib backend when saved
         if print_inside:
             latex2 = R.TLatex()
             latex2.SetNDC()
@@ -104,6 +397,9 @@ class Plot(object):
             latex2.DrawLatex(begin_left, 0.960, text)
 
     def DrawCMS(self,position=0, preliminary=True):
+        self._annotations.append(("DrawCMS", position, preliminary))
+        if self._canvas == None:
+            return
         if preliminary:
             additional_string = 'Preliminary'
         else:
@@ -119,9 +415,15 @@ class Plot(object):
                                0.795, 0.05, 1.0, '', 0.6)
 
     def DrawLumi(self, lumi, textsize=0.6):
+        self._annotations.append(("DrawLumi", lumi, textsize))
+        if self._canvas == None:
+            return
         styles.DrawTitle(self._subplots[0]._pad, lumi, 3, textsize)
 
     def DrawText(self, x, y, text, textsize=0.04):
+        self._annotations.append(("DrawText", x, y, text, textsize))
+        if self._canvas == None:
+            return
         ypos = 0.8
         latex2 = R.TLatex()
         latex2.SetNDC()
@@ -130,13 +432,62 @@ class Plot(object):
         latex2.SetTextSize(textsize)
         latex2.DrawLatex(x, y, text)
 
-    def add_hist(self, hist, name, group_name="invisible"):
+    # Removes the registered histograms and graphs and everything drawn, but
+    # keeps the canvas, the subplots with their axis settings, the legends
+    # with their entries and the lines. The plot can be filled and drawn
+    # again as template, e.g. for the next category of a campaign. Legend
+    # entries are bound to the histograms of the same name when drawn.
+    def clear_hists(self):
+        if self._canvas != None:
+            pads = [subplot._pad.GetName() for subplot in self._subplots]
+            primitives = self._canvas.GetListOfPrimitives()
+            for primitive in list(primitives):
+                if not primitive.GetName() in pads:
+                    primitives.Remove(primitive)
+                    # owned by the canvas, e.g. labels of DrawLatex, as in Clear
+                    if primitive.TestBit(R.TObject.kCanDelete):
+                        primitive.Delete()
+        for subplot in self._subplots:
+            subplot.clear_hists()
+        for legend in self._legends:
+            legend._drawn = False
+        for line in self._lines:
+            line._drawn = False
+        self._shared_copies = {}
+        self._annotations = []
+        if self._canvas != None:
+            self._canvas.cd()
+
+    # With copy_on_write=True a single copy of the histogram is shared by all
+    # subplots, which is only cloned by a subplot that modifies it. Instead of
+    # a histogram a LazyHist or a function returning the histogram can be
+    # given, which is read when a subplot needs it.
+    def add_hist(self, hist, name, group_name="invisible", copy_on_write=False):
+        if _is_function(hist):
+            hist = LazyHist(hist)  # read once for all subplots
+        if copy_on_write:
+            if isinstance(hist, LazyHist):
+                hist = LazyHist(lambda lazy=hist: _copy(lazy.get()))
+            else:
+                hist = _copy(hist)
+            self._shared_copies[id(hist)] = hist
         for subplot in self._subplots:
-            subplot.add_hist(hist=hist, name=name, group_name=group_name)
+            subplot.add_hist(
+                hist=hist,
+                name=name,
+                group_name=group_name,
+                copy_on_write=copy_on_write)
 
-    def add_graph(self, graph, name, group_name="invisible"):
+    def add_graph(self, graph, name, group_name="invisible", copy_on_write=False):
+        if copy_on_write:
+            graph = _copy(graph)
+            self._shared_copies[id(graph)] = graph
         for subplot in self._subplots:
-            subplot.add_graph(graph=graph, name=name, group_name=group_name)
+            subplot.add_graph(
+                graph=graph,
+                name=name,
+                group_name=group_name,
+                copy_on_write=copy_on_write)
 
     def add_legend(self,
                    reference_subplot=0,
@@ -182,13 +533,42 @@ class Plot(object):
                 linewidth=linewidth,
                 markersize=markersize,
                 fillstyle=fillstyle,
-                alpha=alpha)
+                alpha=alpha,
+                shared_inplace=self._shared_copies)
+
+    # sets a styles.StyleSheet for all subplots, which is applied to the drawn
+    # objects without style set by setGraphStyle
+    def setStyleSheet(self, sheet):
+        for subplot in self._subplots:
+            subplot.setStyleSheet(sheet, shared_inplace=True)
 
     def create_stack(self, hist_names, name, group_name="invisible"):
         for subplot in self._subplots:
             subplot.create_stack(
                 hist_names=hist_names, name=name, group_name=group_name)
 
+    # Rebins the histograms of the given names or groups (all histograms if
+    # None) in all subplots and returns the new edges. Without edges, they
+    # are determined from the sum of the reference histograms in the first
+    # subplot, merging bins until the relative statistical uncertainty is
+    # below max_rel_error and/or the content is at least min_yield (see
+    # rebinning.auto_edges).
+    def rebin(self,
+              edges=None,
+              names=None,
+              reference="bkg",
+              max_rel_error=None,
+              min_yield=None):
+        if edges is None:
+            arrays = hist_arrays.get_arrays(
+                self._subplots[0]._get_hist(reference))
+            edges = rebinning.auto_edges(arrays.edges, arrays.contents,
+                                         arrays.sumw2, max_rel_error,
+                                         min_yield)
+        for subplot in self._subplots:
+            subplot.rebin(edges, names, shared_inplace=self._shared_copies)
+        return edges
+
     def scaleXLabelSize(self, val):
         for subplot in self._subplots:
             subplot.scaleXLabelSize(val)
@@ -233,11 +613,11 @@ class Plot(object):
         for subplot in self._subplots:
             subplot.scaleYLabelOffset(val)
 
-    def unroll(self, ur_bin_labels, ur_label_pos = 9, ur_label_angle = 270, ur_label_size = 1.0, selection = None, pads_to_print_labels = None):
+    def unroll(self, ur_bin_labels, ur_label_pos = 9, ur_label_angle = 270, ur_label_size = 1.0, selection = None, pads_to_print_labels = None, single_pad = False):
         empty_labels = ["" for label in ur_bin_labels]
         for i, subplot in enumerate(self._subplots):
             subplot.unroll(ur_bin_labels if (pads_to_print_labels == None or i in pads_to_print_labels) else empty_labels,
-                           ur_label_pos, ur_label_angle, ur_label_size, selection)
+                           ur_label_pos, ur_label_angle, ur_label_size, selection, single_pad)
 
     def changeXLabels(self, replacement_list): #requires list of strings with one string per labeled tick
         for subplot in self._subplots:
@@ -248,32 +628,51 @@ class Plot(object):
             subplot.changeYLabels(replacement_list)
 
 
+# Without margins a TPad is booked for the subplot. Margins [left, right,
+# top, bottom] of the canvas are given for the matplotlib backend, which
+# draws the subplot without pad.
 class Subplot(object):
-    def __init__(self, name, lower_bound=0.0, upper_bound=1.0):
+    def __init__(self, name, lower_bound=0.0, upper_bound=1.0, margins=None):
         logger.debug(
             "Booking subplot with lower boundary at %f and upper boundary at %f"
             % (lower_bound, upper_bound))
-        self._pad = R.TPad("pad_" + str(name), "pad_" + str(name), 0., 0., 1.,
-                           1.)
+        if margins == None:
+            self._pad = R.TPad("pad_" + str(name), "pad_" + str(name), 0., 0.,
+                               1., 1.)
+            margins = [
+                self._pad.GetLeftMargin(), self._pad.GetRightMargin(),
+                self._pad.GetTopMargin(), self._pad.GetBottomMargin()
+            ]
+        else:
+            self._pad = None
         '''
         if lower_bound==0.0:
             lower_bound+=self._pad.GetBottomMargin()
         if upper_bound==1.0:
             upper_bound-=self._pad.GetTopMargin()
         '''
-        drawspaceheight = 1.0 - self._pad.GetBottomMargin(
-        ) - self._pad.GetTopMargin()
-        lower_margin = self._pad.GetBottomMargin(
-        ) + lower_bound * drawspaceheight
-        upper_margin = self._pad.GetTopMargin() + (
-            1 - upper_bound) * drawspaceheight
-        self._pad.SetBottomMargin(lower_margin)
-        self._pad.SetTopMargin(upper_margin)
-        self._pad.SetFillStyle(4000)
-        self._pad.Draw()
+        drawspaceheight = 1.0 - margins[3] - margins[2]
+        lower_margin = margins[3] + lower_bound * drawspaceheight
+        upper_margin = margins[2] + (1 - upper_bound) * drawspaceheight
+        self._margins = [margins[0], margins[1], upper_margin, lower_margin]
+        if self._pad != None:
+            self._pad.SetBottomMargin(lower_margin)
+            self._pad.SetTopMargin(upper_margin)
+            self._pad.SetFillStyle(4000)
+            self._pad.Draw()
 
         self._hists = {}
         self._graphs= {}
+        self._stack_members = {}  # stack name -> names of stacked histograms
+        self._groups = {}  # group name -> names of registered histograms
+        self._group_sums = {}  # group name -> cached sum of the group
+        # groups with members handed out for modification, which are summed
+        # again on each request, None if all histograms were handed out
+        self._handed_out = set()
+        self._deferred = {}  # name -> operations on a LazyHist when read
+        self._style_sheet = None
+        self._style_sheet_inplace = False  # set by the plot for all subplots
+        self._styled = set()  # names with style set or applied from the sheet
         self._xlabel = None
         self._ylabel = None
         self._logx = False
@@ -295,36 +694,110 @@ class Subplot(object):
         self._ylabeloffsetscale = 1.0
         self._height = 1 - upper_margin - lower_margin
         self._unroll = None
+        self._selection = None  # unrolled bins drawn, set by unroll
         self._unroll_pads = []
+        self._is_view = False  # set for the pads of unrolled plots
+        self._axis_frame = None  # keeps a drawn axis copy alive
         self._unroll_label_pos = 9
         self._unroll_label_angle = 270
         self._unroll_label_scalesize = 1.0
+        self._unroll_single_pad = False
+        self._unroll_primitives = []  # separators of single pad unrolling
         self._scale_ticklength = 1.0
+        self._drawn = []  # names passed to Draw, None for DrawAll
 
     @property
     def hists(self):
+        self._group_sums = {}  # histograms may be modified by the caller
+        self._handed_out = None
         return self._hists
 
     @property
     def graphs(self):
         return self._graphs
 
+    # adds the state determining the drawn output to the fingerprint of the plot
+    # returns the margins [left, right, top, bottom], which may have been
+    # changed on the pad
+    def _get_margins(self):
+        if self._pad == None:
+            return list(self._margins)
+        return [
+            self._pad.GetLeftMargin(), self._pad.GetRightMargin(),
+            self._pad.GetTopMargin(), self._pad.GetBottomMargin()
+        ]
+
+    def _update_fingerprint(self, digest):
+        _update_digest(digest, self._get_margins() + [
+            self._xlabel, self._ylabel, self._logx, self._logy, self._grid,
+            self._xlims, self._ylims, self._xlabelsize, self._ylabelsize,
+            self._xtitlesize, self._ytitlesize, self._nxdivisions,
+            self._nydivisions, self._changexlabels, self._changeylabels,
+            self._xtitleoffsetscale, self._ytitleoffsetscale,
+            self._xlabeloffsetscale, self._ylabeloffsetscale, self._unroll,
+            self._unroll_label_pos, self._unroll_label_angle,
+            self._unroll_label_scalesize, self._unroll_single_pad,
+            self._selection, self._scale_ticklength, self._drawn
+        ])
+        for name in sorted(self._hists):
+            entry = self._hists[name]
+            _update_digest(digest, (name, entry[1], entry[2]))
+            if isinstance(entry[0], R.THStack):
+                _update_digest(digest, self._stack_members[name])
+            elif not isinstance(entry[0], LazyHist):  # not drawn if not read
+                _update_hist_digest(digest, entry[0])
+        for name in sorted(self._graphs):
+            entry = self._graphs[name]
+            _update_digest(digest, (name, entry[1], entry[2]))
+            _update_graph_digest(digest, entry[0])
+
+    # removes registered histograms, graphs and drawn objects, the settings
+    # of the subplot are kept
+    def clear_hists(self):
+        for view in self._unroll_pads:
+            view._pad.Clear()
+        if self._pad != None:
+            self._pad.Clear()
+        self._hists = {}
+        self._graphs = {}
+        self._stack_members = {}
+        self._groups = {}
+        self._group_sums = {}
+        self._handed_out = set()
+        self._deferred = {}
+        self._styled = set()
+        self._axis_frame = None
+        self._unroll_pads = []
+        self._unroll_primitives = []
+        self._drawn = []
+
     # adds histogram to subplot and assign individual name and group name. Default group name = "invisible" which is ignored by DrawAll function.
-    def add_hist(self, hist, name, group_name="invisible"):
-        if name in self._hists.keys():
+    # With copy_on_write=True the histogram is not copied but shared with the caller until the subplot modifies it.
+    # A LazyHist or a function returning the histogram is read when the histogram is needed.
+    @profiling.timed("add_hist")
+    def add_hist(self, hist, name, group_name="invisible", copy_on_write=False):
+        if name in self._hists:
             logger.fatal("Histogram name %s already used!")
             raise Exception
+        if _is_function(hist):
+            hist = LazyHist(hist)
+        if isinstance(hist, LazyHist):
+            self._hists[name] = [hist, group_name, "", copy_on_write]
+            self._add_to_group(name, group_name)
+            return
         if not (isinstance(hist, R.TH1D) or isinstance(hist, R.TH1F)):
             logger.fatal(
                 "add_hist expects a TH1F with name {}, got object {}".format(
                     name, hist))
             raise Exception
         self._hists[name] = [
-            copy.deepcopy(hist), group_name, ""
-        ]  # last entry is used to save the markerstyle and set in a different function
+            hist if copy_on_write else _copy(hist), group_name, "",
+            copy_on_write
+        ]  # third entry is used to save the markerstyle and set in a different function, last entry marks shared objects
+        self._add_to_group(name, group_name)
 
-    def add_graph(self, graph, name, group_name="invisible"):
-        if name in self._graphs.keys():
+    def add_graph(self, graph, name, group_name="invisible", copy_on_write=False):
+        if name in self._graphs:
             logger.fatal("Graph name %s already used!")
             raise Exception
         if not isinstance(graph, R.TGraph):
@@ -333,75 +806,240 @@ class Subplot(object):
                     name, graph))
             raise Exception
         self._graphs[name] = [
-            copy.deepcopy(graph), group_name, ""
-        ]  # last entry is used to save the markerstyle and set in a different function
+            graph if copy_on_write else _copy(graph), group_name, "",
+            copy_on_write
+        ]  # third entry is used to save the markerstyle and set in a different function, last entry marks shared objects
+
+    def _add_to_group(self, name, group_name):
+        self._groups.setdefault(group_name, []).append(name)
+        self._group_sums.pop(group_name, None)
+
+    # reads a histogram added as LazyHist and applies the operations deferred
+    # until then. Shared histograms are only kept if all deferred operations
+    # were applied to the objects shared in place.
+    def _materialize(self, name):
+        entry = self._hists[name]
+        if isinstance(entry[0], LazyHist):
+            hist = entry[0].get()
+            if not (isinstance(hist, R.TH1D) or isinstance(hist, R.TH1F)):
+                logger.fatal(
+                    "add_hist expects a TH1F with name {}, got object {}".
+                    format(name, hist))
+                raise Exception
+            operations = self._deferred.pop(name, [])
+            entry[3] = entry[3] and all(
+                [inplace for operation, inplace in operations])
+            entry[0] = hist if entry[3] else _copy(hist)
+            for operation, inplace in operations:
+                operation(entry[0])
+        return entry
+
+    # returns the names of the histograms and graphs of the given names and
+    # groups, stacks are replaced by their histograms
+    def _expand_names(self, names):
+        if isinstance(names, basestring):
+            names = [names]
+        result = []
+        for name in names:
+            if name in self._hists or name in self._graphs:
+                keys = [name]
+            else:
+                keys = self._groups.get(name, [])
+            for key in keys:
+                result += self._stack_members.get(key, [key])
+        return result
+
+    # reads the histograms of the given names and groups
+    def _materialize_names(self, names):
+        for name in self._expand_names(names):
+            if name in self._hists:
+                self._materialize(name)
+
+    # styles the given objects, which are about to be drawn, with the style
+    # sheet unless they already have a style
+    def _apply_style_sheet(self, names):
+        if self._style_sheet == None:
+            return
+        for name in self._expand_names(names):
+            if name in self._styled:
+                continue
+            self._styled.add(name)
+            if name in self._hists:
+                entry = self._hists[name]
+            else:
+                entry = self._graphs[name]
+            style = self._style_sheet.resolve(name, entry[1])
+            if style != None:
+                shared_inplace = {}
+                if self._style_sheet_inplace:
+                    shared_inplace[id(entry[0])] = entry[0]
+                self.setGraphStyle(name, shared_inplace=shared_inplace, **style)
+
+    def setStyleSheet(self, sheet, shared_inplace=False):
+        self._style_sheet = sheet
+        self._style_sheet_inplace = shared_inplace
+
+    # applies an operation to a histogram, which is deferred until it is read
+    # for a LazyHist
+    def _modify_hist(self, name, operation, shared_inplace={}):
+        entry = self._hists[name]
+        if isinstance(entry[0], LazyHist):
+            self._deferred.setdefault(name, []).append(
+                (operation, id(entry[0]) in shared_inplace))
+        else:
+            operation(self._own_hist(name, shared_inplace))
+
+    # called before a histogram is modified: replaces a shared histogram by a
+    # private copy and drops the cached sum of its group. Objects contained
+    # in shared_inplace are kept and modified in place.
+    def _own_hist(self, name, shared_inplace={}):
+        entry = self._materialize(name)
+        self._group_sums.pop(entry[1], None)
+        if entry[3] and not id(entry[0]) in shared_inplace:
+            entry[0] = _copy(entry[0])
+            entry[3] = False
+            for stack_name, members in self._stack_members.items():
+                if name in members:
+                    self._rebuild_stack(stack_name)
+        return entry[0]
+
+    def _own_graph(self, name, shared_inplace={}):
+        entry = self._graphs[name]
+        if entry[3] and not id(entry[0]) in shared_inplace:
+            entry[0] = _copy(entry[0])
+            entry[3] = False
+        return entry[0]
+
+    # refills a stack after one of its histograms has been replaced
+    def _rebuild_stack(self, name):
+        stack = R.THStack("hs", "")
+        for member in self._stack_members[name]:
+            stack.Add(self._hists[member][0])
+        self._hists[name][0] = stack
 
     # returns histogram with given name or sum of histograms with given group name
     def get_hist(self, name):
-        if name in self._hists.keys():
+        if name in self._hists:
+            self._own_hist(name)  # returned object may be modified
+            if self._handed_out != None:
+                self._handed_out.add(self._hists[name][1])
+            return self._get_hist(name)
+        return _copy(self._get_hist(name))
+
+    # same as get_hist, but returns shared histograms and cached group sums
+    # without copy, which must not be modified
+    def _get_hist(self, name):
+        self._materialize_names(name)
+        if name in self._hists:
             if isinstance(self._hists[name][0], R.THStack):
                 logger.fatal("get_hist does not accept names of stacks!")
                 raise Exception
             return self._hists[name][0]
+        elif name in self._group_sums:
+            return self._group_sums[name]
         else:
             empty = True
-            for entry in self._hists.values():
-                if entry[1] == name:
-                    if isinstance(entry[0], R.THStack):
-                        logger.fatal(
-                            "get_hist does not accept names of stacks!")
-                        raise Exception
-                    if empty:
-                        hist = copy.deepcopy(entry[0])
-                        hist.SetName(name)
-                        empty = False
-                    else:
-                        hist.Add(entry[0])
+            for key in self._groups.get(name, []):
+                entry = self._hists[key]
+                if isinstance(entry[0], R.THStack):
+                    logger.fatal(
+                        "get_hist does not accept names of stacks!")
+                    raise Exception
+                if empty:
+                    hist = _copy(entry[0])
+                    hist.SetName(name)
+                    empty = False
+                else:
+                    hist.Add(entry[0])
             if empty:
                 logger.fatal("No histograms matching to name %s" % name)
                 raise Exception
             else:
+                if self._handed_out != None and not name in self._handed_out:
+                    self._group_sums[name] = hist
                 return hist
 
     def get_graph(self, name):
-        if name in self._graphs.keys():
+        if name in self._graphs:
             return self._graphs[name]
 
     # draws all histograms assigned to the subplot except those with group name "invisible"
     def DrawAll(self):
+        self._drawn.append(None)
+        names = [
+            name for name in self._hists
+            if self._hists[name][1] != "invisible"
+        ]
+        self._materialize_names(names)
+        self._apply_style_sheet(names)
+        if self._pad == None:
+            self._check_matplotlib()
+            return  # drawn by the matplotlib backend when saved
         if isinstance(self._unroll, list):
             self.DrawUnrolled([entry for entry in self._hists() if not self._hists[entry][1] == "invisible"])
         else:
             isFirst = True
-            for hist in self._hists.values():
+            for name, hist in self._hists.items():
                 if not hist[1] == "invisible":
+                    if isFirst:
+                        self._own_first(name)
                     self.DrawSingle(hist, isFirst)
                     isFirst = False
             R.gPad.RedrawAxis()
 
     # draws specific histograms assigned to the subplot selected via a list of individual names and/or group names
     def Draw(self, names):
+        self._drawn.append(names)
+        self._materialize_names(names)
+        self._apply_style_sheet(names)
+        if self._pad == None:
+            self._check_matplotlib()
+            return  # drawn by the matplotlib backend when saved
         if isinstance(self._unroll, list):
-            self.DrawUnrolled(names)
+            if self._unroll_single_pad:
+                self.DrawUnrolledSinglePad(names)
+            else:
+                self.DrawUnrolled(names)
         else:
-            if isinstance(names, basestring):
-                names = [names]
-            isFirst = True
-            for name in names:
-                if name in self._hists.keys():
-                    self.DrawSingle(self._hists[name], isFirst)
-                    isFirst = False
-                elif name in self._graphs.keys():
-                    self.DrawSingle(self._graphs[name], isFirst)
+            self._DrawNames(names)
+
+    def _DrawNames(self, names):
+        if isinstance(names, basestring):
+            names = [names]
+        isFirst = True
+        for name in names:
+            if name in self._hists:
+                if isFirst:
+                    self._own_first(name)
+                self.DrawSingle(self._hists[name], isFirst)
+                isFirst = False
+            elif name in self._graphs:
+                if isFirst and not self._is_view:
+                    self._own_graph(name)
+                self.DrawSingle(self._graphs[name], isFirst)
+                isFirst = False
+            else:
+                for key in self._groups.get(name, []):
+                    if isFirst:
+                        self._own_first(key)
+                    self.DrawSingle(self._hists[key], isFirst)
                     isFirst = False
-                else:
-                    for entry in self._hists.values():
-                        if entry[1] == name:
-                            self.DrawSingle(entry, isFirst)
-                            isFirst = False
-            R.gPad.RedrawAxis()
+        R.gPad.RedrawAxis()
+
+    def _check_matplotlib(self):
+        if self._unroll != None:
+            logger.fatal(
+                "Unrolled plots are not supported by the matplotlib backend!")
+            raise Exception
+
+    # the first drawn histogram carries the axis style of the subplot. Views
+    # draw a copy instead, since they share the histograms with their parent.
+    def _own_first(self, name):
+        if not self._is_view and not isinstance(self._hists[name][0], R.THStack):
+            self._own_hist(name)
 
     # draws single ROOT histogram. If isFirst is True, formatting is applied and histogram overwrites existing drawings, else it is added
+    @profiling.timed("DrawSingle")
     def DrawSingle(self, hist, isFirst):
         self._pad.cd()
         if isFirst:
@@ -409,11 +1047,16 @@ class Subplot(object):
             if self._ylims != None and isinstance(
                     hist[0], R.THStack
             ):  # otherwise lims are not set without a unintended margin
-                copystack = copy.deepcopy(hist[0])
-                axishist = copystack.GetHists()[0]
+                axishist = _copy(hist[0].GetHists()[0])
+                self._axis_frame = axishist
                 self.setAxisStyles(axishist)
                 axishist.Draw(hist[2])
                 hist[0].Draw(hist[2] + "SAME")
+            elif self._is_view and not isinstance(hist[0], R.THStack):
+                self._axis_frame = _copy(hist[0])
+                self._axis_frame.Draw()
+                self.setAxisStyles(self._axis_frame)
+                self._axis_frame.Draw(hist[2])
             else:
                 hist[0].Draw()  # needed for stacks
                 self.setAxisStyles(hist[0])
@@ -421,33 +1064,50 @@ class Subplot(object):
         else:
             hist[0].Draw(hist[2] + "SAME")
 
-    def DrawUnrolled(self, names):
+    # borders of the unrolled bins on the x axis
+    def _unroll_axis_borders(self, names):
         if not isinstance(self._unroll, list):
             logger.fatal("A list of bin labels must be given for unrolling!")
             raise Exception
         n_bins = len(self._unroll)
-        n_selected_bins = len(self._selection)
-        #determine ranges
         if self._xlims == None:
             hist = self._hists[names[0]][0]
             if isinstance(hist, R.THStack):
                 hist = hist.GetHists()[0]
             self._xlims = [hist.GetXaxis().GetXmin(), hist.GetXaxis().GetXmax()]
         axis_borders = [self._xlims[0]]
-        pad_borders = [self._pad.GetLeftMargin()]
         axisrange = self._xlims[1] - self._xlims[0]
         inv_round_order = 10.0**(4-math.floor(math.log10(axisrange)))
         for i in range(n_bins):
             axis_borders.append(int((self._xlims[0] + axisrange / n_bins * (i + 1))*inv_round_order)/inv_round_order)
+        return axis_borders
+
+    # y range of unrolled plots without fixed limits
+    def _unroll_ylims(self, names):
+        hist = self._hists[names[0]][0]
+        if isinstance(hist, R.THStack):
+            hist = hist.GetHists()[0]
+        ylims = [hist.GetMinimum()/1.1, hist.GetMaximum()*1.2]
+        if self._logy and ylims[0] == 0.0:
+            ylims[0] = ylims[1]/10.0
+        return ylims
+
+    @profiling.timed("DrawUnrolled")
+    def DrawUnrolled(self, names):
+        n_bins = len(self._unroll)
+        n_selected_bins = len(self._selection)
+        #determine ranges
+        axis_borders = self._unroll_axis_borders(names)
+        pad_borders = [self._pad.GetLeftMargin()]
+        axisrange = self._xlims[1] - self._xlims[0]
         for i in range(n_selected_bins):
             pad_borders.append(self._pad.GetLeftMargin() + (1.0 - self._pad.GetRightMargin() - self._pad.GetLeftMargin()) / n_selected_bins * (i + 1))
         #fix ticklengths
         self._scale_ticklength = 2.0 / n_bins
         #create subpads
-        copy_me = copy.deepcopy(self)
         margin = 0.01 * axisrange / n_bins
         for i, idx in enumerate(self._selection):
-            self._unroll_pads.append(copy.deepcopy(copy_me))
+            self._unroll_pads.append(self._unroll_view(i))
             self._unroll_pads[i]._unroll = self._unroll[idx]
             self._unroll_pads[i]._xlims = [axis_borders[idx] + margin, axis_borders[idx+1] - margin]
             self._unroll_pads[i]._pad.SetLeftMargin(pad_borders[i])
@@ -471,18 +1131,101 @@ class Subplot(object):
                 
             #fix y range
             if self._ylims == None:
-                hist = self._hists[names[0]][0]
-                if isinstance(hist, R.THStack):
-                    copystack = copy.deepcopy(hist)
-                    hist = copystack.GetHists()[0]
-                self._unroll_pads[i]._ylims = [hist.GetMinimum()/1.1, hist.GetMaximum()*1.2]
-                if self._logy and self._unroll_pads[i]._ylims[0] == 0.0:
-                    self._unroll_pads[i]._ylims[0] = self._unroll_pads[i]._ylims[1]/10.0
+                self._unroll_pads[i]._ylims = self._unroll_ylims(names)
         #draw subpads
         for unroll_pad in self._unroll_pads:
             unroll_pad.Draw(names)
             styles.DrawText(unroll_pad._pad, unroll_pad._unroll, unroll_pad._unroll_label_scalesize, self._unroll_label_pos, self._unroll_label_angle)
 
+    # draws the unrolled histograms once in the pad of the subplot. The
+    # unrolled bins are separated by dashed lines and labeled in the same pad,
+    # the x axis ticks are relabeled per unrolled bin via changeXLabels.
+    @profiling.timed("DrawUnrolledSinglePad")
+    def DrawUnrolledSinglePad(self, names):
+        if isinstance(names, basestring):
+            names = [names]
+        selection = sorted(self._selection)
+        if selection != list(range(selection[0], selection[-1] + 1)):
+            logger.fatal("Single pad unrolling requires consecutive selected bins!")
+            raise Exception
+        n_selected_bins = len(selection)
+        # automatic settings only apply to this drawing, the settings given
+        # by the user are restored afterwards
+        settings = [self._xlims, self._ylims, self._nxdivisions,
+                    self._changexlabels]
+        axis_borders = self._unroll_axis_borders(names)
+        low = axis_borders[selection[0]]
+        high = axis_borders[selection[-1] + 1]
+        #fix ticks and labels, the tick length of the full-width pad is kept
+        offs = axis_borders[0]
+        incr = (axis_borders[1] - axis_borders[0]) / 4.0
+        if 4 * n_selected_bins < 100:  # at most 99 primary divisions
+            ticks_per_bin = 4
+            bin_labels = [" "] + ["{:.1f}".format(offs + j * incr) for j in range(1, 4)]
+        else:
+            ticks_per_bin = 1
+            bin_labels = [" "]
+        if self._nxdivisions == None:
+            self._nxdivisions = [ticks_per_bin * n_selected_bins, 0, 4, False]
+        if self._changexlabels == None:
+            self._changexlabels = bin_labels * n_selected_bins + [" "]
+        #draw histograms in the range of the selected bins
+        self._xlims = [low, high]
+        if self._ylims == None:
+            self._ylims = self._unroll_ylims(names)
+        self._DrawNames(names)
+        self._xlims, self._ylims, self._nxdivisions, self._changexlabels = settings
+        #draw separators and labels
+        left = self._pad.GetLeftMargin()
+        right = 1.0 - self._pad.GetRightMargin()
+        top = 1.0 - self._pad.GetTopMargin()
+        bottom = self._pad.GetBottomMargin()
+        scale = (right - left) / (high - low)
+        self._unroll_primitives = []
+        for i, idx in enumerate(selection):
+            bin_left = left + (axis_borders[idx] - low) * scale
+            bin_right = left + (axis_borders[idx + 1] - low) * scale
+            if i > 0:
+                line = R.TLine()
+                line.SetLineStyle(2)
+                line.SetLineColor(R.kBlack)
+                self._unroll_primitives.append(
+                    line.DrawLineNDC(bin_left, bottom, bin_left, top))
+            styles.DrawText(self._pad, self._unroll[idx], self._unroll_label_scalesize,
+                            self._unroll_label_pos, self._unroll_label_angle,
+                            borders=[bin_left, bin_right, top, bottom])
+
+    # Lightweight copy of the subplot for a single unrolled bin. It has its own
+    # pad, limits and label settings, but references the histograms, stacks
+    # and graphs of this subplot instead of copying them.
+    def _unroll_view(self, index):
+        view = copy.copy(self)
+        name = "%s_unroll_%d" % (self._pad.GetName(), index)
+        view._pad = R.TPad(name, name, 0., 0., 1., 1.)
+        view._pad.SetLeftMargin(self._pad.GetLeftMargin())
+        view._pad.SetRightMargin(self._pad.GetRightMargin())
+        view._pad.SetTopMargin(self._pad.GetTopMargin())
+        view._pad.SetBottomMargin(self._pad.GetBottomMargin())
+        view._pad.SetFillStyle(4000)
+        for attribute in ["_xlims", "_ylims", "_nxdivisions", "_nydivisions",
+                          "_changexlabels", "_changeylabels"]:
+            value = getattr(self, attribute)
+            if isinstance(value, list):
+                setattr(view, attribute, list(value))
+        # own bookkeeping, the histogram entries are shared with the subplot
+        view._group_sums = dict(self._group_sums)
+        view._handed_out = None if self._handed_out == None else set(
+            self._handed_out)
+        view._deferred = dict(
+            [(name, list(operations))
+             for name, operations in self._deferred.items()])
+        view._styled = set(self._styled)
+        view._drawn = []
+        view._unroll_pads = []
+        view._is_view = True
+        view._axis_frame = None
+        return view
+
     def setXlabel(self, label):
         self._xlabel = label
 
@@ -625,25 +1368,33 @@ class Subplot(object):
                       markersize=1,
                       linestyle=1,
                       fillstyle=1001,
-                      alpha=1.0):
+                      alpha=1.0,
+                      shared_inplace={}):
         markerstyledict = {}
-        if markerstyle in markerstyledict.keys():
+        if markerstyle in markerstyledict:
             markerstyle = markerstyledict[markerstyle]
-        if name in self._hists.keys():
+
+        def set_style(hist):
+            hist.SetMarkerStyle(markershape)
+            hist.SetMarkerColor(markercolor)
+            hist.SetLineColor(linecolor)
+            hist.SetFillColor(fillcolor)
+            hist.SetLineWidth(linewidth)
+            hist.SetMarkerSize(markersize)
+            hist.SetLineStyle(linestyle)
+            hist.SetFillStyle(fillstyle)
+
+        if name in self._hists:
             if isinstance(self._hists[name][0], R.THStack):
                 logger.warning(
                     "Adressed object is stack. Style cannot be set!")
                 return
+            self._styled.add(name)
             self._hists[name][2] = markerstyle
-            self._hists[name][0].SetMarkerStyle(markershape)
-            self._hists[name][0].SetMarkerColor(markercolor)
-            self._hists[name][0].SetLineColor(linecolor)
-            self._hists[name][0].SetFillColor(fillcolor)
-            self._hists[name][0].SetLineWidth(linewidth)
-            self._hists[name][0].SetMarkerSize(markersize)
-            self._hists[name][0].SetLineStyle(linestyle)
-            self._hists[name][0].SetFillStyle(fillstyle)
-        elif name in self._graphs.keys():
+            self._modify_hist(name, set_style, shared_inplace)
+        elif name in self._graphs:
+            self._styled.add(name)
+            self._own_graph(name, shared_inplace)
             self._graphs[name][2] = markerstyle
             self._graphs[name][0].SetMarkerStyle(markershape)
             self._graphs[name][0].SetMarkerColor(markercolor)
@@ -654,48 +1405,49 @@ class Subplot(object):
             self._graphs[name][0].SetLineStyle(linestyle)
             self._graphs[name][0].SetFillStyle(fillstyle)
         else:
-            for hist in self._hists.values():
-                if hist[1] == name:
-                    if isinstance(hist[0], R.THStack):
-                        logger.warning(
-                            "Adressed object is stack. Style cannot be set!")
-                        return
-                    hist[2] = markerstyle
-                    hist[0].SetMarkerStyle(markershape)
-                    hist[0].SetMarkerColor(markercolor)
-                    hist[0].SetLineColor(linecolor)
-                    hist[0].SetFillColor(fillcolor)
-                    hist[0].SetLineWidth(linewidth)
-                    hist[0].SetMarkerSize(markersize)
-                    hist[0].SetLineStyle(linestyle)
-                    hist[0].SetFillStyle(fillstyle)
+            for key in self._groups.get(name, []):
+                hist = self._hists[key]
+                if isinstance(hist[0], R.THStack):
+                    logger.warning(
+                        "Adressed object is stack. Style cannot be set!")
+                    return
+                self._styled.add(key)
+                hist[2] = markerstyle
+                self._modify_hist(key, set_style, shared_inplace)
 
     # creates stack from registered histograms defined via name or group name
+    @profiling.timed("create_stack")
     def create_stack(self, hist_names, name, group_name="invisible"):
-        if name in self._hists.keys():
+        if name in self._hists:
             logger.fatal("Stack name %s already used!" % name)
             raise Exception
         stack = R.THStack("hs", "")
+        members = []
         # regularize inputs
         if isinstance(hist_names, basestring):
             hist_names = [hist_names]
+        self._materialize_names(hist_names)
         for hist_name in hist_names:
-            if hist_name in self._hists.keys():
+            if hist_name in self._hists:
                 stack.Add(self._hists[hist_name][0])
+                members.append(hist_name)
                 logger.debug(
                     "Added histogram %s to stack %s" % (hist_name, name))
             else:
-                for key, hist in self._hists.iteritems():
-                    if hist_name == hist[1]:
-                        if isinstance(hist[0], R.THStack):
-                            logger.fatal(
-                                "Tried to import a stack into a stack, which is impossible!"
-                            )
-                            raise Exception
-                        stack.Add(hist[0])
-                        logger.debug(
-                            "Added histogram %s to stack %s" % (key, name))
-        self._hists[name] = [stack, group_name, "hist"]
+                for key in self._groups.get(hist_name, []):
+                    hist = self._hists[key]
+                    if isinstance(hist[0], R.THStack):
+                        logger.fatal(
+                            "Tried to import a stack into a stack, which is impossible!"
+                        )
+                        raise Exception
+                    stack.Add(hist[0])
+                    members.append(key)
+                    logger.debug(
+                        "Added histogram %s to stack %s" % (key, name))
+        self._hists[name] = [stack, group_name, "hist", False]
+        self._stack_members[name] = members
+        self._add_to_group(name, group_name)
 
     # normalizes one or more histograms to a given denominator
     def normalize(self, nominator_names, denominator_names):
@@ -709,46 +1461,82 @@ class Subplot(object):
         isFirst = True
         for name in denominator_names:
             if isFirst:
-                denominator = copy.deepcopy(self.get_hist(name))
+                denominator = _copy(self._get_hist(name))
                 isFirst = False
             else:
-                denominator.Add(self.get_hist(name))
+                denominator.Add(self._get_hist(name))
         # do not propagate denominator errors
         for i in xrange(1, denominator.GetNbinsX() + 1):
             denominator.SetBinError(i, 0.)
 
         # normalize all nominator inputs
         for name in nominator_names:
-            if name in self._hists.keys():
+            if name in self._hists:
                 if isinstance(self._hists[name][0], R.THStack):
                     logger.fatal("Stacks cannot be normalized!")
                     raise Exception
-                self._hists[name][0].Divide(denominator)
+                self._own_hist(name).Divide(denominator)
             else:
-                for hist in self._hists.values():
-                    if hist[1] == name:
-                        if isinstance(hist[0], R.THStack):
-                            logger.fatal("Stacks cannot be normalized!")
-                            raise Exception
-                        hist[0].Divide(denominator)
+                for key in self._groups.get(name, []):
+                    if isinstance(self._hists[key][0], R.THStack):
+                        logger.fatal("Stacks cannot be normalized!")
+                        raise Exception
+                    self._own_hist(key).Divide(denominator)
 
     # normalizes bin contents of all histograms in the subplot to their bin width
     def normalizeByBinWidth(self):
-        for hist in self._hists.values():
+        def divide(hist):
+            denominator = _copy(hist)
+            for i in range(denominator.GetNbinsX()):
+                denominator.SetBinContent(i + 1,
+                                          denominator.GetBinWidth(i + 1))
+                denominator.SetBinError(i + 1, 0.0)
+            hist.Divide(denominator)
+
+        for name, hist in self._hists.items():
             if not isinstance(hist[0], R.THStack):
-                denominator = copy.deepcopy(hist[0])
-                for i in range(denominator.GetNbinsX()):
-                    denominator.SetBinContent(i + 1,
-                                              denominator.GetBinWidth(i + 1))
-                    denominator.SetBinError(i + 1, 0.0)
-                hist[0].Divide(denominator)
-
-
-    def unroll(self, ur_bin_labels, ur_label_pos = 9, ur_label_angle = 270, ur_label_size = 1.0, selection = None):
+                self._modify_hist(name, divide)
+
+
+    # Rebins the histograms of the given names or groups, or all histograms,
+    # to the given edges, which must be edges of the current binning. Stacks
+    # of given names are rebinned by rebinning their histograms.
+    def rebin(self, edges, names=None, shared_inplace={}):
+        if names == None:
+            names = [
+                name for name in self._hists
+                if not name in self._stack_members
+            ]
+        elif isinstance(names, basestring):
+            names = [names]
+        keys = []
+        for name in names:
+            if name in self._stack_members:
+                keys += self._stack_members[name]
+            elif name in self._hists:
+                keys.append(name)
+            else:
+                keys += [
+                    key for key in self._groups.get(name, [])
+                    if not key in self._stack_members
+                ]
+        edges = np.asarray(edges, dtype=np.float64)
+        for key in set(keys):
+            self._modify_hist(key, lambda hist: rebinning.rebin(hist, edges),
+                              shared_inplace)
+        for stack_name, members in self._stack_members.items():
+            if any([member in keys for member in members]):
+                self._rebuild_stack(stack_name)
+
+    # With single_pad=True the unrolled histograms are drawn once in the pad of
+    # the subplot, separating the unrolled bins by lines instead of drawing
+    # one pad per bin. The selected bins have to be consecutive in this case.
+    def unroll(self, ur_bin_labels, ur_label_pos = 9, ur_label_angle = 270, ur_label_size = 1.0, selection = None, single_pad = False):
         self._unroll = ur_bin_labels
         self._unroll_label_pos = ur_label_pos
         self._unroll_label_angle = ur_label_angle
         self._unroll_label_scalesize = ur_label_size
+        self._unroll_single_pad = single_pad
         if selection == None:
             self._selection = range(len(self._unroll))
         else:
@@ -778,11 +1566,20 @@ class Line(object):
         self.reference_subplot = subplots[reference_subplot]
         self._subplots = subplots
         self._line = R.TLine(xmin, ymin, xmax, ymax)
+        self._spec = (reference_subplot, xmin, ymin, xmax, ymax)
+        self._drawn = False
         self.color = color
         self.linestyle = linestyle
         self.linewidth = linewidth
+
+    def _update_fingerprint(self, digest):
+        _update_digest(digest, (self._spec, self.color, self.linestyle,
+                                self.linewidth, self._drawn))
     
     def Draw(self):
+        self._drawn = True
+        if self.reference_subplot._pad == None:
+            return  # drawn by the matplotlib backend when saved
         self.reference_subplot._pad.cd()
         self._line.SetLineWidth(self.linewidth)
         self._line.SetLineStyle(self.linestyle)
@@ -801,36 +1598,49 @@ class Legend(object):
         o = offset
         w = width
         h = height
-        l = subplots[reference_subplot]._pad.GetLeftMargin()
-        t = subplots[reference_subplot]._pad.GetTopMargin()
-        b = subplots[reference_subplot]._pad.GetBottomMargin()
-        r = subplots[reference_subplot]._pad.GetRightMargin()
-        if pos == 1:
+        l, r, t, b = subplots[reference_subplot]._get_margins()
+        self._legend = None  # not used by the matplotlib backend
+        if subplots[reference_subplot]._pad == None:
+            pass
+        elif pos == 1:
             self._legend = R.TLegend(l + o, 1 - t - o - h, l + o + w,
                                      1 - t - o, '', 'NBNDC')
-        if pos == 2:
+        elif pos == 2:
             c = l + 0.5 * (1 - l - r)
             self._legend = R.TLegend(c - 0.5 * w, 1 - t - o - h, c + 0.5 * w,
                                      1 - t - o, '', 'NBNDC')
-        if pos == 3:
+        elif pos == 3:
             self._legend = R.TLegend(1 - r - o - w, 1 - t - o - h, 1 - r - o,
                                      1 - t - o, '', 'NBNDC')
-        if pos == 4:
+        elif pos == 4:
             self._legend = R.TLegend(l + o, b + o, l + o + w, b + o + h, '',
                                      'NBNDC')
-        if pos == 5:
+        elif pos == 5:
             c = l + 0.5 * (1 - l - r)
             self._legend = R.TLegend(c - 0.5 * w, b + o, c + 0.5 * w,
                                      b + o + h, '', 'NBNDC')
-        if pos == 6:
+        elif pos == 6:
             self._legend = R.TLegend(1 - r - o - w, b + o, 1 - r - o,
                                      b + o + h, '', 'NBNDC')
         self._subplots = subplots
+        self._spec = (reference_subplot, width, height, pos, offset)
+        self._entries = []
+        self._drawn = False
         self._textsizescale = 1.
         self._ncolumns = 1
         self._FillColor = 0
         self._alpha = 1.0
 
+    def _update_fingerprint(self, digest):
+        _update_digest(digest, (self._spec, self._entries, self._textsizescale,
+                                self._ncolumns, self._FillColor, self._alpha,
+                                self._drawn))
+
+    @property
+    def nentries(self):
+        return len(self._entries)
+
+    # entries are bound to the registered objects when the legend is drawn
     def add_entry(self, subplot_index, histname, label, style):
         if not isinstance(subplot_index, int):
             logger.fatal("Subplot index is supposed to be of type int!")
@@ -838,12 +1648,23 @@ class Legend(object):
         if subplot_index >= len(self._subplots):
             logger.fatal("Subplot index is out of range!")
             raise Exception
-        if histname in self._subplots[subplot_index]._hists.keys():
-            self._legend.AddEntry(
-                self._subplots[subplot_index]._hists[histname][0], label, style)
-        elif histname in self._subplots[subplot_index]._graphs.keys():
-            self._legend.AddEntry(
-                self._subplots[subplot_index]._graphs[histname][0], label, style)
+        subplot = self._subplots[subplot_index]
+        if not (histname in subplot._hists or histname in subplot._graphs):
+            logger.fatal("Requested histogram for legend does not exist!")
+            raise Exception
+        self._entries.append((subplot_index, histname, label, style))
+
+    def clear_entries(self):
+        self._entries = []
+
+    def _get_entry_object(self, subplot_index, histname):
+        subplot = self._subplots[subplot_index]
+        if histname in subplot._hists:
+            subplot._apply_style_sheet(histname)
+            return subplot._materialize(histname)[0]
+        elif histname in subplot._graphs:
+            subplot._apply_style_sheet(histname)
+            return subplot._graphs[histname][0]
         else:
             logger.fatal("Requested histogram for legend does not exist!")
             raise Exception
@@ -852,7 +1673,9 @@ class Legend(object):
         self._textsizescale = scale
 
     def setNColumns(self, number):
-        self._legend.SetNColumns(number)
+        self._ncolumns = number
+        if self._legend != None:
+            self._legend.SetNColumns(number)
 
     def setFillColor(self, val):
         self._FillColor = val
@@ -861,6 +1684,15 @@ class Legend(object):
         self._alpha = val
 
     def Draw(self):
+        self._drawn = True
+        if self._legend == None:
+            for subplot_index, histname, label, style in self._entries:
+                self._get_entry_object(subplot_index, histname)  # read now
+            return  # drawn by the matplotlib backend when saved
+        self._legend.Clear()
+        for subplot_index, histname, label, style in self._entries:
+            self._legend.AddEntry(
+                self._get_entry_object(subplot_index, histname), label, style)
         self._legend.SetTextFont(42)
         self._legend.SetTextSize(0.025 * self._textsizescale)
         self._legend.SetFillColorAlpha(self._FillColor, self._alpha)
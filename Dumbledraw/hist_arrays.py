@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import collections
+import numpy as np
+logger = logging.getLogger(__name__)
+
+# bin edges (nbins + 1) and per-bin contents, sum of squared weights and
+# lower/upper errors as contiguous float64 arrays
+HistArrays = collections.namedtuple(
+    "HistArrays", ["edges", "contents", "sumw2", "errors_down", "errors_up"])
+
+# numpy types of the TH1 bin buffers, identified by the last letter of the class name
+_buffer_dtypes = {
+    "D": np.float64,
+    "F": np.float32,
+    "I": np.int32,
+    "S": np.int16,
+    "C": np.int8
+}
+
+
+def _read_buffer(tarray, dtype, size):
+    return np.array(
+        np.frombuffer(tarray, dtype=dtype, count=size), dtype=np.float64)
+
+
+# reads the TH1 buffers directly instead of looping over bins via PyROOT. With
+# flow=True the under- and overflow bins are included in the bin arrays.
+def get_arrays(hist, flow=False):
+    classname = hist.ClassName()
+    if not classname.startswith("TH1") or not classname[-1] in _buffer_dtypes:
+        logger.fatal("get_arrays expects a TH1, got object {}".format(hist))
+        raise Exception
+    nbins = hist.GetNbinsX()
+    ncells = nbins + 2
+
+    axis = hist.GetXaxis()
+    if axis.GetXbins().GetSize() > 0:
+        edges = _read_buffer(axis.GetXbins().GetArray(), np.float64, nbins + 1)
+    else:
+        edges = np.linspace(axis.GetXmin(), axis.GetXmax(), nbins + 1)
+
+    contents = _read_buffer(hist.GetArray(), _buffer_dtypes[classname[-1]],
+                            ncells)
+    if hist.GetSumw2N() > 0:
+        sumw2 = _read_buffer(hist.GetSumw2().GetArray(), np.float64, ncells)
+    else:
+        sumw2 = np.abs(contents)
+
+    if hist.GetBinErrorOption() == 0:  # TH1::kNormal, symmetric errors
+        errors_down = np.sqrt(sumw2)
+        errors_up = errors_down.copy()
+    else:
+        # Poisson intervals are only available bin by bin
+        errors_down = np.array(
+            [hist.GetBinErrorLow(i) for i in range(ncells)], dtype=np.float64)
+        errors_up = np.array(
+            [hist.GetBinErrorUp(i) for i in range(ncells)], dtype=np.float64)
+
+    if not flow:
+        contents = contents[1:-1]
+        sumw2 = sumw2[1:-1]
+        errors_down = errors_down[1:-1]
+        errors_up = errors_up[1:-1]
+    return HistArrays(
+        np.ascontiguousarray(edges), np.ascontiguousarray(contents),
+        np.ascontiguousarray(sumw2), np.ascontiguousarray(errors_down),
+        np.ascontiguousarray(errors_up))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import collections
+import ROOT
+logger = logging.getLogger(__name__)
+
+# bytes per bin of the TH1 content buffers, identified by the last letter of the class name
+_bin_sizes = {"D": 8, "F": 4, "I": 4, "S": 2, "C": 1}
+
+
+# memory used by the bin buffers of a histogram (contents and sumw2)
+def hist_nbytes(hist):
+    ncells = hist.GetNcells()
+    nbytes = ncells * _bin_sizes.get(hist.ClassName()[-1], 8)
+    if hist.GetSumw2N() > 0:
+        nbytes += ncells * 8
+    return nbytes
+
+
+# identifies the state of a file on disk, so that cached histograms of a
+# rewritten file are not reused
+def file_id(filename):
+    filename = os.path.abspath(filename)
+    return (filename, os.path.getmtime(filename))
+
+
+# LRU cache of histograms read by the parsers. Entries are evicted by the
+# total memory of their bin buffers instead of the number of entries. The
+# cache keeps detached copies and hands out clones, so callers may modify the
+# returned histograms.
+class HistogramCache(object):
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # key -> [hist, nbytes]
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.RLock()
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    @property
+    def nentries(self):
+        return len(self._entries)
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def evictions(self):
+        return self._evictions
+
+    def stats(self):
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "entries": len(self._entries),
+            "bytes": self._nbytes,
+            "max_bytes": self._max_bytes
+        }
+
+    def reset_stats(self):
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    # returns a clone of the cached histogram, calling fetch() on a miss
+    def get(self, key, fetch):
+        with self._lock:
+            if key in self._entries:
+                entry = self._entries.pop(key)
+                self._entries[key] = entry  # mark as most recently used
+                self._hits += 1
+                return self._clone(entry[0])
+            self._misses += 1
+        hist = fetch()
+        if not hist:
+            return hist
+        nbytes = hist_nbytes(hist)
+        if nbytes > self._max_bytes:
+            logger.debug("Histogram %s exceeds the cache budget, not cached" % (key, ))
+            return hist
+        hist.SetDirectory(0)  # keep the cached copy independent of the file
+        ROOT.SetOwnership(hist, True)  # freed when evicted
+        with self._lock:
+            if not key in self._entries:
+                self._entries[key] = [hist, nbytes]
+                self._nbytes += nbytes
+                self._evict()
+        return self._clone(hist)
+
+    def _clone(self, hist):
+        clone = hist.Clone()
+        clone.SetDirectory(0)
+        ROOT.SetOwnership(clone, True)
+        return clone
+
+    def _evict(self):
+        while self._nbytes > self._max_bytes and len(self._entries) != 0:
+            key, entry = self._entries.popitem(last=False)
+            self._nbytes -= entry[1]
+            self._evictions += 1
+            logger.debug("Evicted %s from histogram cache" % (key, ))
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import logging
+import threading
+import numpy as np
+import ROOT as R
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.patches import Patch
+from matplotlib.lines import Line2D
+import hist_arrays
+logger = logging.getLogger(__name__)
+
+# Renders a Plot created with backend="matplotlib" from the arrays of the
+# registered histograms and graphs. Only the Agg canvas of each figure is
+# used, neither pyplot nor gPad, so that plots can be saved from parallel
+# threads. The text rendering of matplotlib (mathtext parser and font cache)
+# is not thread-safe, therefore the final drawing and writing of the figures
+# is serialized, while the figures are set up in parallel. Text sizes given
+# as fraction of the pad height follow the ROOT conventions.
+
+formats = ["png", "pdf", "svg", "eps", "jpg", "jpeg"]
+
+_colors = {}  # ROOT color index -> rgb
+_colors_lock = threading.Lock()
+_render_lock = threading.Lock()
+
+_linestyles = {1: "-", 2: "--", 3: ":", 4: "-.", 5: "-.", 6: "-.", 7: "--"}
+_markers = {
+    1: ".",
+    2: "+",
+    3: "*",
+    5: "x",
+    20: "o",
+    21: "s",
+    22: "^",
+    23: "v",
+    24: "o",
+    25: "s",
+    26: "^",
+    29: "*",
+    33: "D",
+    34: "P"
+}
+_hollow_markers = [24, 25, 26]
+_legend_locations = {
+    1: "upper left",
+    2: "upper center",
+    3: "upper right",
+    4: "lower left",
+    5: "lower center",
+    6: "lower right"
+}
+
+
+# converts a ROOT color index, e.g. of styles.color_dict, to rgba
+def color(index, alpha=1.0):
+    if not index in _colors:
+        with _colors_lock:
+            tcolor = R.gROOT.GetColor(index)
+            if tcolor:
+                _colors[index] = (tcolor.GetRed(), tcolor.GetGreen(),
+                                  tcolor.GetBlue())
+            else:
+                _colors[index] = (0.0, 0.0, 0.0)
+    return _colors[index] + (alpha, )
+
+
+# converts the TLatex syntax of ROOT, e.g. "#mu#tau_{h}", to mathtext
+def latex(text):
+    if text == None:
+        return None
+    if not ("#" in text or "_{" in text or "^{" in text):
+        return text
+    text = re.sub(r"#([A-Za-z]+)", r"\\\1", text)
+    return "$%s$" % text.replace(" ", r"\ ")
+
+
+def _points(textsize, height):
+    return textsize * height * 0.72  # fraction of the canvas height at 100 dpi
+
+
+def save(plot, outputnames):
+    for name in outputnames:
+        if not name.split(".")[-1].lower() in formats:
+            logger.fatal("Format of %s is not supported by the matplotlib backend!"
+                         % name)
+            raise Exception
+    width, height = plot._size
+    figure = Figure(figsize=(width / 100.0, height / 100.0), dpi=100)
+    FigureCanvasAgg(figure)
+    arrays = {}  # id of histogram -> arrays, read once per plot
+    axes = [
+        _draw_subplot(figure, subplot, arrays, height)
+        for subplot in plot._subplots
+    ]
+    for legend in plot._legends:
+        if legend._drawn:
+            _draw_legend(axes, legend, height)
+    for line in plot._lines:
+        if line._drawn and axes[line._spec[0]] != None:
+            _draw_line(axes[line._spec[0]], line)
+    for annotation in plot._annotations:
+        _draw_annotation(figure, axes, annotation, height)
+    for name in outputnames:
+        with _render_lock:
+            figure.savefig(name)
+        logger.info("Created %s" % name)
+
+
+def _get_arrays(hist, arrays):
+    if not id(hist) in arrays:
+        arrays[id(hist)] = hist_arrays.get_arrays(hist)
+    return arrays[id(hist)]
+
+
+# returns the names of the registered objects in the order of drawing
+def _drawn_names(subplot):
+    result = []
+    for names in subplot._drawn:
+        if names == None:  # DrawAll
+            names = [
+                name for name in subplot._hists
+                if subplot._hists[name][1] != "invisible"
+            ]
+        elif isinstance(names, basestring):
+            names = [names]
+        for name in names:
+            if name in subplot._hists or name in subplot._graphs:
+                result.append(name)
+            else:
+                result += subplot._groups.get(name, [])
+    return result
+
+
+def _draw_subplot(figure, subplot, arrays, height):
+    names = _drawn_names(subplot)
+    if len(names) == 0:
+        return None
+    l, r, t, b = subplot._margins
+    ax = figure.add_axes([l, b, 1.0 - l - r, 1.0 - t - b])
+    xrange = None
+    for name in names:
+        if name in subplot._graphs:
+            entry = subplot._graphs[name]
+            _draw_graph(ax, entry[0], entry[2].lower())
+            continue
+        entry = subplot._hists[name]
+        if isinstance(entry[0], R.THStack):
+            edges = _draw_stack(ax, [
+                subplot._hists[member][0]
+                for member in subplot._stack_members[name]
+            ], arrays)
+        else:
+            edges = _draw_hist(ax, entry[0], entry[2].lower(), arrays)
+        if xrange == None and edges is not None:
+            xrange = [edges[0], edges[-1]]
+    _set_axis_styles(ax, subplot, xrange, height)
+    return ax
+
+
+def _step(values):
+    return np.append(values, values[-1])
+
+
+# fill of the matplotlib patches for the ROOT fill style, hatched for the
+# 3xxx patterns
+def _fill(obj):
+    fillstyle = obj.GetFillStyle()
+    if fillstyle == 0:
+        return {"facecolor": "none", "edgecolor": "none"}
+    elif fillstyle >= 3000 and fillstyle < 4000:
+        return {
+            "facecolor": "none",
+            "edgecolor": color(obj.GetFillColor()),
+            "hatch": "////"
+        }
+    return {"facecolor": color(obj.GetFillColor()), "edgecolor": "none"}
+
+
+def _draw_stack(ax, hists, arrays):
+    if len(hists) == 0:
+        return None
+    lower = None
+    for hist in hists:
+        a = _get_arrays(hist, arrays)
+        if lower is None:
+            lower = np.zeros_like(a.contents)
+        upper = lower + a.contents
+        ax.fill_between(
+            a.edges,
+            _step(lower),
+            _step(upper),
+            step="post",
+            linewidth=0,
+            **_fill(hist))
+        ax.step(
+            a.edges,
+            _step(upper),
+            where="post",
+            color=color(hist.GetLineColor()),
+            linestyle=_linestyles.get(hist.GetLineStyle(), "-"),
+            linewidth=hist.GetLineWidth())
+        lower = upper
+    return a.edges
+
+
+def _draw_hist(ax, hist, option, arrays):
+    a = _get_arrays(hist, arrays)
+    centers = 0.5 * (a.edges[1:] + a.edges[:-1])
+    if "e2" in option:
+        ax.fill_between(
+            a.edges,
+            _step(a.contents - a.errors_down),
+            _step(a.contents + a.errors_up),
+            step="post",
+            linewidth=0,
+            **_fill(hist))
+    elif "e" in option or "p" in option:
+        markerstyle = hist.GetMarkerStyle()
+        markercolor = color(hist.GetMarkerColor())
+        ax.errorbar(
+            centers,
+            a.contents,
+            yerr=[a.errors_down, a.errors_up] if "e" in option else None,
+            fmt=_markers.get(markerstyle, "o"),
+            markersize=5.0 * hist.GetMarkerSize(),
+            markerfacecolor="none"
+            if markerstyle in _hollow_markers else markercolor,
+            markeredgecolor=markercolor,
+            ecolor=color(hist.GetLineColor()),
+            elinewidth=hist.GetLineWidth(),
+            linestyle="none")
+    else:  # "hist" and default option
+        if hist.GetFillColor() != 0:
+            ax.fill_between(
+                a.edges,
+                0.0,
+                _step(a.contents),
+                step="post",
+                linewidth=0,
+                **_fill(hist))
+        ax.step(
+            a.edges,
+            _step(a.contents),
+            where="post",
+            color=color(hist.GetLineColor()),
+            linestyle=_linestyles.get(hist.GetLineStyle(), "-"),
+            linewidth=hist.GetLineWidth())
+    return a.edges
+
+
+def _graph_buffer(graph, getter):
+    n = graph.GetN()
+    return np.frombuffer(getattr(graph, getter)(), dtype=np.float64, count=n)
+
+
+def _draw_graph(ax, graph, option):
+    if graph.GetN() == 0:
+        return
+    x = _graph_buffer(graph, "GetX")
+    y = _graph_buffer(graph, "GetY")
+    if graph.InheritsFrom("TGraphAsymmErrors"):
+        yerr = [
+            _graph_buffer(graph, "GetEYlow"),
+            _graph_buffer(graph, "GetEYhigh")
+        ]
+    elif graph.InheritsFrom("TGraphErrors"):
+        yerr = _graph_buffer(graph, "GetEY")
+    else:
+        yerr = None
+    if "2" in option and yerr is not None:
+        if isinstance(yerr, list):
+            low, high = yerr
+        else:
+            low, high = yerr, yerr
+        ax.fill_between(
+            x,
+            y - low,
+            y + high,
+            linewidth=0,
+            **_fill(graph))
+    elif "p" in option or "e" in option:
+        ax.errorbar(
+            x,
+            y,
+            yerr=yerr,
+            fmt=_markers.get(graph.GetMarkerStyle(), "o"),
+            markersize=5.0 * graph.GetMarkerSize(),
+            color=color(graph.GetMarkerColor()),
+            linestyle="none")
+    else:
+        ax.plot(
+            x,
+            y,
+            color=color(graph.GetLineColor()),
+            linestyle=_linestyles.get(graph.GetLineStyle(), "-"),
+            linewidth=graph.GetLineWidth())
+
+
+def _set_axis_styles(ax, subplot, xrange, height):
+    labelsize = _points(0.035, height)
+    titlesize = _points(0.04, height)
+    if subplot._logx:
+        ax.set_xscale("log")
+    if subplot._logy:
+        ax.set_yscale("log", nonposy="clip")
+    if subplot._xlims != None:
+        ax.set_xlim(*subplot._xlims)
+    elif xrange != None:
+        ax.set_xlim(*xrange)
+    if subplot._ylims != None:
+        ylims = list(subplot._ylims)
+        if subplot._logy and ylims[0] <= 0.0:
+            ylims[0] = 0.00001
+        ax.set_ylim(*ylims)
+    ax.tick_params(
+        which="both", direction="in", top=True, right=True,
+        labelsize=labelsize * (subplot._xlabelsize or 1.0))
+    ax.tick_params(axis="y", labelsize=labelsize * (subplot._ylabelsize or 1.0))
+    if subplot._xlabel == None:
+        ax.tick_params(axis="x", labelbottom=False)
+    else:
+        ax.set_xlabel(
+            latex(subplot._xlabel),
+            fontsize=titlesize * (subplot._xtitlesize or 1.0),
+            horizontalalignment="right",
+            x=1.0)
+    if subplot._ylabel == None:
+        ax.tick_params(axis="y", labelleft=False)
+    else:
+        ax.set_ylabel(
+            latex(subplot._ylabel),
+            fontsize=titlesize * (subplot._ytitlesize or 1.0),
+            horizontalalignment="right",
+            y=1.0)
+    if subplot._grid:
+        ax.grid(axis="y")
+
+
+def _legend_handle(obj, style):
+    style = style.lower()
+    if "f" in style:
+        return Patch(**_fill(obj))
+    if "p" in style:
+        return Line2D([], [],
+                      marker=_markers.get(obj.GetMarkerStyle(), "o"),
+                      markersize=5.0 * obj.GetMarkerSize(),
+                      color=color(obj.GetMarkerColor()),
+                      linestyle="none")
+    return Line2D([], [],
+                  color=color(obj.GetLineColor()),
+                  linestyle=_linestyles.get(obj.GetLineStyle(), "-"),
+                  linewidth=obj.GetLineWidth())
+
+
+def _draw_legend(axes, legend, height):
+    reference_subplot, width, legend_height, pos, offset = legend._spec
+    ax = axes[reference_subplot]
+    if ax == None:
+        return
+    handles = []
+    labels = []
+    for subplot_index, histname, label, style in legend._entries:
+        handles.append(
+            _legend_handle(
+                legend._get_entry_object(subplot_index, histname), style))
+        labels.append(latex(label))
+    drawn = ax.legend(
+        handles,
+        labels,
+        loc=_legend_locations.get(pos, "upper right"),
+        ncol=legend._ncolumns,
+        fontsize=_points(0.025 * legend._textsizescale, height),
+        borderaxespad=offset * 30.0,
+        fancybox=False)
+    drawn.get_frame().set_facecolor(color(legend._FillColor, legend._alpha))
+    drawn.get_frame().set_edgecolor("none")
+
+
+def _draw_line(ax, line):
+    reference_subplot, xmin, ymin, xmax, ymax = line._spec
+    ax.plot([xmin, xmax], [ymin, ymax],
+            color=color(line.color),
+            linestyle=_linestyles.get(line.linestyle, "-"),
+            linewidth=line.linewidth,
+            scalex=False,
+            scaley=False)
+
+
+def _draw_annotation(figure, axes, annotation, height):
+    ax = axes[0] if axes[0] != None else figure
+    transform = ax.transAxes if ax != figure else figure.transFigure
+    if annotation[0] == "DrawChannelCategoryLabel":
+        text, textsize, begin_left, print_inside = annotation[1:]
+        if print_inside:
+            figure.text(0.39, 0.72, latex(text), fontsize=_points(0.02, height))
+        else:
+            figure.text(
+                0.145 if begin_left == None else begin_left,
+                0.96,
+                latex(text),
+                fontsize=_points(textsize, height))
+    elif annotation[0] == "DrawCMS":
+        position, preliminary = annotation[1:]
+        if position == "outside":
+            x, y, va, ha = 0.0, 1.01, "bottom", "left"
+        elif position == 0:
+            x, y, va, ha = 0.045, 0.95, "top", "left"
+        else:
+            x, y, va, ha = 0.955, 0.95, "top", "right"
+        ax.text(x, y, "CMS", transform=transform, fontsize=_points(0.06, height),
+                fontweight="bold", verticalalignment=va,
+                horizontalalignment=ha)
+        if preliminary and position == "outside":
+            ax.text(x + 0.13, y, "Preliminary", transform=transform,
+                    fontsize=_points(0.045, height), fontstyle="italic",
+                    verticalalignment=va, horizontalalignment=ha)
+        elif preliminary:
+            ax.text(x, y - 0.07, "Preliminary", transform=transform,
+                    fontsize=_points(0.045, height), fontstyle="italic",
+                    verticalalignment=va, horizontalalignment=ha)
+    elif annotation[0] == "DrawLumi":
+        lumi, textsize = annotation[1:]
+        ax.text(1.0, 1.01, latex(lumi), transform=transform,
+                fontsize=_points(0.06 * textsize, height),
+                verticalalignment="bottom", horizontalalignment="right")
+    elif annotation[0] == "DrawText":
+        x, y, text, textsize = annotation[1:]
+        figure.text(x, y, latex(text), fontsize=_points(textsize, height))
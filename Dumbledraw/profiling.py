@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import threading
+import functools
+import logging
+import tfile_pool
+logger = logging.getLogger(__name__)
+
+# Records wall time, number of calls and bytes read from ROOT files per phase
+# (e.g. reading, copying, drawing or saving) and per plot. The bytes are those
+# read from the files of the TFile pool of the thread running the phase, so
+# that reads ahead in another thread are not attributed to it. Profiling is
+# disabled by default and enabled with the environment variable
+# DUMBLEDRAW_PROFILE=1 or with enable(). When disabled the instrumented
+# functions only check a global flag.
+_enabled = os.environ.get("DUMBLEDRAW_PROFILE", "0") not in ["", "0"]
+_lock = threading.Lock()
+_stats = {}  # (plot, phase) -> [calls, seconds, bytes read]
+_events = []  # complete events of the Chrome trace format
+_local = threading.local()  # label of the current plot per thread
+
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    global _stats, _events
+    with _lock:
+        _stats = {}
+        _events = []
+
+
+def _current_plot():
+    return getattr(_local, "plot", "")
+
+
+def _bytes_read():
+    return tfile_pool.get_pool().bytes_read()
+
+
+def _record(name, start, duration, nbytes):
+    with _lock:
+        plot = _current_plot()
+        entry = _stats.setdefault((plot, name), [0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += duration
+        entry[2] += nbytes
+        _events.append({
+            "name": name,
+            "cat": plot,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": duration * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.current_thread().ident,
+            "args": {
+                "bytes_read": nbytes
+            }
+        })
+
+
+# Context manager timing the enclosed code as phase with the given name,
+# e.g. "with profiling.phase('fit'):". Nested phases are timed inclusively.
+class phase(object):
+    def __init__(self, name):
+        self._name = name
+        self._active = False
+
+    def __enter__(self):
+        self._active = _enabled and self._name != None
+        if self._active:
+            self._bytes = _bytes_read()
+            self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._active:
+            _record(self._name, self._start, time.time() - self._start,
+                    _bytes_read() - self._bytes)
+        return False
+
+
+# Decorator timing each call of a function as phase with the given name
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Context manager assigning the phases of the enclosed code in the current
+# thread to a plot, which is itself recorded as phase "plot" unless
+# timed=False, e.g. for reading ahead the inputs of the plot
+class plot_scope(object):
+    def __init__(self, label, timed=True):
+        self._label = str(label)
+        self._phase = phase("plot" if timed else None)
+
+    def __enter__(self):
+        self._previous = _current_plot()
+        _local.plot = self._label
+        self._phase.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._phase.__exit__(*exc_info)
+        _local.plot = self._previous
+        return False
+
+
+# Returns and resets the recorded data, e.g. to send it from a worker process
+# to the main process of a campaign, where it is added with merge
+def collect():
+    global _stats, _events
+    with _lock:
+        data = {
+            "stats": [[plot, name] + values
+                      for (plot, name), values in _stats.items()],
+            "events": _events
+        }
+        _stats = {}
+        _events = []
+    return data
+
+
+def merge(data):
+    with _lock:
+        for plot, name, calls, seconds, nbytes in data["stats"]:
+            entry = _stats.setdefault((plot, name), [0, 0.0, 0])
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] += nbytes
+        _events.extend(data["events"])
+
+
+# Returns the summary table of all phases, or of the time spent per plot
+# with per_plot=True, sorted by total time
+def summary(per_plot=False):
+    totals = {}
+    with _lock:
+        for (plot, name), values in _stats.items():
+            key = plot if per_plot else name
+            if per_plot and name != "plot":
+                continue
+            entry = totals.setdefault(key, [0, 0.0, 0])
+            for i in range(3):
+                entry[i] += values[i]
+    lines = ["%-40s %8s %10s %10s %10s" % ("plot" if per_plot else "phase",
+                                           "calls", "total [s]", "mean [ms]",
+                                           "read [MB]")]
+    for key, (calls, seconds, nbytes) in sorted(
+            totals.items(), key=lambda item: -item[1][1]):
+        lines.append("%-40s %8d %10.3f %10.3f %10.3f" %
+                     (key, calls, seconds, 1e3 * seconds / calls,
+                      nbytes / 1024.0**2))
+    return "\n".join(lines)
+
+
+def log_summary(per_plot=False):
+    logger.info("Profiling summary (inclusive times):\n%s" %
+                summary(per_plot))
+
+
+# writes the timeline in the Chrome trace format, which can be opened with
+# chrome://tracing or https://ui.perfetto.dev
+def write_trace(filename):
+    with _lock:
+        events = list(_events)
+    with open(filename, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    logger.info("Created %s" % filename)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import numpy as np
+import hist_arrays
+logger = logging.getLogger(__name__)
+
+# (old edges, new edges) -> start indices of the merged cells, shared by all
+# histograms with the same binning
+_merge_maps = {}
+_lock = threading.Lock()
+
+
+# Returns the indices of the cells (including under- and overflow) at which
+# the merged cells start, to be used with np.add.reduceat. The new edges must
+# be a subset of the old ones. Bins outside of the new range are merged into
+# the under- and overflow.
+def merge_map(edges, new_edges):
+    edges = np.asarray(edges, dtype=np.float64)
+    new_edges = np.asarray(new_edges, dtype=np.float64)
+    key = (edges.tobytes(), new_edges.tobytes())
+    with _lock:
+        if key in _merge_maps:
+            return _merge_maps[key]
+    if len(new_edges) < 2 or np.any(np.diff(new_edges) <= 0.0):
+        logger.fatal("Bin edges must be increasing, got %s!" % new_edges)
+        raise Exception
+    indices = np.clip(np.searchsorted(edges, new_edges), 0, len(edges) - 1)
+    # nearest old edge, tolerating rounding of the given edges
+    lower = np.clip(indices - 1, 0, len(edges) - 1)
+    nearer = np.abs(edges[lower] - new_edges) < np.abs(edges[indices] -
+                                                        new_edges)
+    indices = np.where(nearer, lower, indices)
+    scale = max(np.max(np.abs(edges)), 1.0)
+    if not np.allclose(edges[indices], new_edges, rtol=0.0,
+                       atol=1e-9 * scale) or np.any(np.diff(indices) <= 0):
+        logger.fatal("Bin edges %s are not a subset of the edges %s!" %
+                     (new_edges, edges))
+        raise Exception
+    starts = np.concatenate([[0], indices + 1])
+    with _lock:
+        _merge_maps[key] = starts
+    return starts
+
+
+# merges contents or sums of squared weights of the cells in the last axis,
+# e.g. of the histograms of all processes at once
+def merge(values, starts):
+    return np.add.reduceat(np.asarray(values, dtype=np.float64), starts,
+                           axis=-1)
+
+
+# Returns edges merging the bins of the given contents and sums of squared
+# weights, starting at the upper end, until each merged bin has a relative
+# statistical uncertainty below max_rel_error and a content of at least
+# min_yield. Remaining bins at the lower end, which do not fulfill the
+# conditions, are merged into the lowest merged bin.
+def auto_edges(edges, contents, sumw2, max_rel_error=None, min_yield=None):
+    if max_rel_error == None and min_yield == None:
+        logger.fatal("Automatic rebinning requires max_rel_error or min_yield!")
+        raise Exception
+    # cumulative sums from the upper end, the sums of a block are differences
+    contents = np.cumsum(np.asarray(contents, dtype=np.float64)[::-1])
+    sumw2 = np.cumsum(np.asarray(sumw2, dtype=np.float64)[::-1])
+    nbins = len(contents)
+    kept = [nbins]  # indices of the kept edges
+    done = 0  # number of bins merged from the upper end
+    for i in xrange(nbins):
+        content = contents[i] - (contents[done - 1] if done > 0 else 0.0)
+        w2 = sumw2[i] - (sumw2[done - 1] if done > 0 else 0.0)
+        fulfilled = (min_yield == None or content >= min_yield) and (
+            max_rel_error == None or
+            (content > 0.0 and np.sqrt(w2) < max_rel_error * content))
+        if fulfilled:
+            done = i + 1
+            kept.append(nbins - done)
+    if kept[-1] != 0:
+        if len(kept) > 1:
+            kept.pop()
+        kept.append(0)
+    return np.asarray(edges, dtype=np.float64)[sorted(kept)]
+
+
+# Rebins a histogram in place to the given edges and returns it. Contents and
+# squared weights are summed, the errors are the square root of the summed
+# squared weights.
+def rebin(hist, new_edges):
+    arrays = hist_arrays.get_arrays(hist, flow=True)
+    new_edges = np.asarray(new_edges, dtype=np.float64)
+    if np.array_equal(arrays.edges, new_edges):
+        return hist
+    starts = merge_map(arrays.edges, new_edges)
+    contents = merge(arrays.contents, starts)
+    errors = np.sqrt(merge(arrays.sumw2, starts))
+    hist.SetBins(len(new_edges) - 1, new_edges)
+    hist.SetContent(contents)
+    hist.SetError(errors)
+    return hist
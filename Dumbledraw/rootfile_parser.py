@@ -4,15 +4,26 @@
 import logging
 import ROOT
 import copy
+import tfile_pool
+import hist_cache
+import hist_arrays
+import profiling
 logger = logging.getLogger(__name__)
 
 
 class Rootfile_parser(object):
-    def __init__(self, inputrootfilename, mode="CombineHarvester"):
+    def __init__(self, inputrootfilename, mode="CombineHarvester", cache=None):
         self._rootfilename = inputrootfilename
-        self._rootfile = ROOT.TFile(self._rootfilename, "READ")
+        self._pool = tfile_pool.get_pool()
+        self._rootfile = self._pool.acquire(self._rootfilename, "READ")
+        # optional hist_cache.HistogramCache shared between parsers
+        self._cache = cache
+        self._file_id = hist_cache.file_id(inputrootfilename) if cache != None else None
         self._type = "control"
-        content = [entry.GetName() for entry in self._rootfile.GetListOfKeys()]
+        # index of directory -> key names, top level is read right away and
+        # subdirectories are added on first use
+        self._keys = {}
+        content = self._get_keys("")
         for entry in content:
             if entry.endswith("prefit"):
                 self._type = "prefit"
@@ -29,81 +40,195 @@ class Rootfile_parser(object):
             logger.fatal("Cannot detect mode to open file {}.".format(mode))
             raise Exception
         logger.debug("Use mode {} to read file.".format(mode))
+        # fill the plot type once, only era, channel, category, process and
+        # uncertainty are left to be formatted per histogram
+        self._resolved_hash = self._hist_hash.format(
+            era="{era}",
+            channel="{channel}",
+            category="{category}",
+            process="{process}",
+            plottype="" if self._type == "control" else "_" + self._type,
+            unc="{unc}")
 
     @property
     def rootfile(self):
         return self._rootfile
 
-    def get(self, era, channel, category, process, syst=None):
+    # returns the key names of a directory ("" for the top level) as a list
+    # and a set for fast membership tests, reading the TKey list only once
+    def _get_key_index(self, directory):
+        if not directory in self._keys:
+            if directory == "":
+                tdir = self._rootfile
+            elif directory in self._keys[""][1]:
+                tdir = self._rootfile.Get(directory)
+            else:
+                tdir = None
+            names = []
+            seen = set()
+            if tdir and tdir.InheritsFrom("TDirectory"):
+                for entry in tdir.GetListOfKeys():
+                    name = entry.GetName()
+                    if not name in seen:  # skip additional key cycles
+                        seen.add(name)
+                        names.append(name)
+            self._keys[directory] = (names, seen)
+        return self._keys[directory]
+
+    def _get_keys(self, directory):
+        return self._get_key_index(directory)[0]
+
+    # reads a histogram from the file or from the cache if one is set
+    @profiling.timed("read")
+    def _read(self, hist_hash):
+        if self._cache == None:
+            return self._rootfile.Get(hist_hash)
+        return self._cache.get((self._file_id, hist_hash),
+                               lambda: self._rootfile.Get(hist_hash))
+
+    # resolves the full path of a histogram inside the file
+    def _format_hash(self, era, channel, category, process, syst=None):
         if syst != None and self._type != "control":
             logger.fatal(
                 "Uncertainty shapes are only available in control plots!")
             raise Exception
-        hist_hash = self._hist_hash.format(
+        return self._resolved_hash.format(
             era=era,
             channel=channel,
             category=category,
             process=process,
-            plottype="{plottype}",
-            unc="{unc}")
-        if self._type == "control":
-            syst = "" if syst == None else "_" + syst
-            hist_hash = hist_hash.format(plottype="", unc=syst)
-        else:
-            hist_hash = hist_hash.format(plottype="_" + self._type, unc="")
+            unc="" if syst == None else "_" + syst)
+
+    # returns the histogram and whether it exists. Missing histograms are
+    # replaced by an empty dummy taken from the same directory.
+    def _get_hash(self, hist_hash, process):
         logger.debug(
             "Try to access %s in %s" % (hist_hash, self._rootfilename))
-        # perform check if file is available and otherwise return some dummy TH1F
-        available_processes = [entry.GetName() for entry in self._rootfile.Get(hist_hash.split('/')[0]).GetListOfKeys()]
-        if hist_hash.split('/')[1] in available_processes:
-            return self._rootfile.Get(hist_hash)
+        directory, histname = hist_hash.split('/')
+        available_processes, available_set = self._get_key_index(directory)
+        if histname in available_set:
+            return self._read(hist_hash), True
         elif len(available_processes) != 0:
-            logger.warning("%s in %s does not exist !" % (hist_hash, self._rootfilename))
-            logger.debug(" Available Histograms are: %s" % available_processes)
-            logger.debug(" Returning a dummy histogram ")
-            dummy = self._rootfile.Get('{}/{}'.format(hist_hash.split('/')[0],available_processes[0]))
+            dummy = self._read('{}/{}'.format(directory, available_processes[0]))
             dummy.Reset()
             dummy.SetTitle(process)
             dummy.SetName(hist_hash)
-            return dummy
+            return dummy, False
         else:
-            logger.fatal(" None of the requested Histograms are available in %s. Aborting." % hist_hash.split('/')[0])
+            logger.fatal(" None of the requested Histograms are available in %s. Aborting." % directory)
             raise Exception
 
+    @profiling.timed("parser.get")
+    def get(self, era, channel, category, process, syst=None):
+        hist_hash = self._format_hash(era, channel, category, process, syst)
+        # perform check if file is available and otherwise return some dummy TH1F
+        hist, exists = self._get_hash(hist_hash, process)
+        if not exists:
+            logger.warning("%s in %s does not exist !" % (hist_hash, self._rootfilename))
+            logger.debug(" Available Histograms are: %s" % self._get_keys(hist_hash.split('/')[0]))
+            logger.debug(" Returning a dummy histogram ")
+        return hist
 
-    def get_bins(self, era, channel, category, process, syst=None):
+    # fetches the Cartesian product of the given channels, categories,
+    # processes (and systematics) in one pass. Returns a nested dict
+    # result[channel][category][process] (with an additional [syst] level if
+    # systs are given). Missing histograms are replaced by dummies as in get
+    # and reported in a single warning.
+    def get_many(self, era, channels, categories, processes, systs=None):
+        # regularize inputs
+        if isinstance(channels, basestring):
+            channels = [channels]
+        if isinstance(categories, basestring):
+            categories = [categories]
+        if isinstance(processes, basestring):
+            processes = [processes]
+        if isinstance(systs, basestring):
+            systs = [systs]
+        result = {}
+        missing = []
+        for channel in channels:
+            result[channel] = {}
+            for category in categories:
+                result[channel][category] = {}
+                for process in processes:
+                    if systs == None:
+                        hist_hash = self._format_hash(era, channel, category,
+                                                      process)
+                        hist, exists = self._get_hash(hist_hash, process)
+                        result[channel][category][process] = hist
+                        if not exists:
+                            missing.append(hist_hash)
+                        continue
+                    result[channel][category][process] = {}
+                    for syst in systs:
+                        hist_hash = self._format_hash(era, channel, category,
+                                                      process, syst)
+                        hist, exists = self._get_hash(hist_hash, process)
+                        result[channel][category][process][syst] = hist
+                        if not exists:
+                            missing.append(hist_hash)
+        if len(missing) != 0:
+            logger.warning("%d requested histograms in %s do not exist, returning dummy histograms: %s"
+                           % (len(missing), self._rootfilename, ", ".join(missing)))
+        return result
+
+    # Returns a dict process -> sorted names of the systematics with both an
+    # Up and a Down variation {process}_{syst}Up/Down in the directory of the
+    # channel and category, found in a single pass over its key index. Keys
+    # are assigned to the longest matching process, so that e.g. "ZTT_emb_x"
+    # variations do not appear as systematics of "ZTT" if "ZTT_emb" is given.
+    def get_variations(self, era, channel, category, processes):
+        if isinstance(processes, basestring):
+            processes = [processes]
+        directory = self._format_hash(era, channel, category,
+                                      "").split('/')[0]
+        by_length = sorted(processes, key=len, reverse=True)
+        shifts = {}  # (process, syst) -> found shifts
+        for name in self._get_keys(directory):
+            if name.endswith("Up"):
+                shift, base = "Up", name[:-2]
+            elif name.endswith("Down"):
+                shift, base = "Down", name[:-4]
+            else:
+                continue
+            for process in by_length:
+                if base.startswith(process + "_"):
+                    key = (process, base[len(process) + 1:])
+                    shifts.setdefault(key, set()).add(shift)
+                    break
+        result = dict([(process, []) for process in processes])
+        for (process, syst), found in shifts.items():
+            if len(found) == 2:
+                result[process].append(syst)
+            else:
+                logger.warning("Skip systematic %s of %s without %s variation"
+                               % (syst, process,
+                                  "Down" if "Up" in found else "Up"))
+        for process in processes:
+            result[process].sort()
+        return result
+
+    # returns edges, contents, sumw2 and lower/upper errors as numpy arrays
+    def get_arrays(self, era, channel, category, process, syst=None, flow=False):
         hist = self.get(era, channel, category, process, syst)
-        nbins = hist.GetNbinsX()
-        bins = []
-        for i in range(nbins):
-            bins.append(hist.GetBinLowEdge(i + 1))
-        bins.append(hist.GetBinLowEdge(i + 1) + hist.GetBinWidth(i + 1))
-        return bins
+        return hist_arrays.get_arrays(hist, flow)
+
+    def get_bins(self, era, channel, category, process, syst=None):
+        return self.get_arrays(era, channel, category, process,
+                               syst).edges.tolist()
 
     def get_values(self, era, channel, category, process, syst=None):
-        hist = self.get(era, channel, category, process, syst)
-        nbins = hist.GetNbinsX()
-        values = []
-        for i in range(nbins):
-            values.append(hist.GetBinContent(i + 1))
-        return values
+        return self.get_arrays(era, channel, category, process,
+                               syst).contents.tolist()
 
     def get_values_up(self, era, channel, category, process, syst=None):
-        hist = self.get(era, channel, category, process, syst)
-        nbins = hist.GetNbinsX()
-        values = []
-        for i in range(nbins):
-            values.append(hist.GetBinErrDown(i + 1))
-        return values
+        return self.get_arrays(era, channel, category, process,
+                               syst).errors_up.tolist()
 
     def get_values_down(self, era, channel, category, process, syst=None):
-        hist = self.get(era, channel, category, process, syst)
-        nbins = hist.GetNbinsX()
-        values = []
-        for i in range(nbins):
-            values.append(hist.GetBinErrDown(i + 1))
-        return values
+        return self.get_arrays(era, channel, category, process,
+                               syst).errors_down.tolist()
 
     def __del__(self):
-        logger.debug("Closing rootfile %s" % (self._rootfilename))
-        self._rootfile.Close()
+        logger.debug("Releasing rootfile %s" % (self._rootfilename))
+        self._pool.release(self._rootfilename, "READ")
@@ -4,37 +4,127 @@
 import logging
 import ROOT
 import copy
+import re
+import fnmatch
+import collections
+import tfile_pool
+import hist_cache
+import profiling
 logger = logging.getLogger(__name__)
 
+# fields of the keys #channel#category#process#analysis#epoch#variable#mass#
+Key = collections.namedtuple(
+    "Key",
+    ["channel", "category", "process", "analysis", "epoch", "variable", "mass"])
+_key_format = "#{channel}#{category}#{process}#{analysis}#{epoch}#{variable}#{mass}#"
+
+
+# returns the Key of a key name or None if it does not follow the format
+def parse_key(name):
+    if not (name.startswith("#") and name.endswith("#")):
+        return None
+    fields = name[1:-1].split("#")
+    if len(fields) != len(Key._fields):
+        return None
+    return Key(*fields)
+
+
+# matches single values of a field, patterns without wildcards are compared
+# directly
+def _matcher(pattern):
+    pattern = str(pattern)
+    if pattern == "*":
+        return lambda value: True
+    if not any([char in pattern for char in "*?["]):
+        return lambda value: value == pattern
+    return re.compile(fnmatch.translate(pattern)).match
+
 
 class Rootfile_parser(object):
-    def __init__(self, inputrootfilename, analysis, epoch, variable, mass):
+    def __init__(self, inputrootfilename, analysis, epoch, variable, mass, cache=None):
         self._rootfilename = inputrootfilename
-        self._rootfile = ROOT.TFile(self._rootfilename, "READ")
+        self._pool = tfile_pool.get_pool()
+        self._rootfile = self._pool.acquire(self._rootfilename, "READ")
+        # optional hist_cache.HistogramCache shared between parsers
+        self._cache = cache
+        self._file_id = hist_cache.file_id(inputrootfilename) if cache != None else None
         self._type = "control"
         self._analysis = analysis
         self._epoch = epoch
         self._variable = variable
         self._mass = mass
+        self._index = None  # Key -> key name, built on first use
 
     @property
     def rootfile(self):
         return self._rootfile
 
+    # reads a histogram from the file or from the cache if one is set
+    @profiling.timed("read")
+    def _read(self, hist_hash):
+        if self._cache == None:
+            return self._rootfile.Get(hist_hash)
+        return self._cache.get((self._file_id, hist_hash),
+                               lambda: self._rootfile.Get(hist_hash))
+
+    # parses all key names of the file once
+    def _get_index(self):
+        if self._index == None:
+            self._index = collections.OrderedDict()
+            for entry in self._rootfile.GetListOfKeys():
+                name = entry.GetName()
+                key = parse_key(name)
+                if key == None:
+                    logger.debug("Skip key %s in %s, which has no valid format"
+                                 % (name, self._rootfilename))
+                elif not key in self._index:  # skip additional key cycles
+                    self._index[key] = name
+        return self._index
+
+    # Returns the histogram of the given channel, category and process for
+    # the analysis, epoch, variable and mass of the parser. Histograms which
+    # do not exist are not read and None is returned.
+    @profiling.timed("parser.get")
     def get(self, channel, category, process):
-        hist_hash = "#{channel}#{category}#{process}#{analysis}#{epoch}#{variable}#{mass}#".format(
-            channel=channel,
-            category=category,
-            process=process,
-            analysis=self._analysis,
-            epoch=self._epoch,
-            variable=self._variable,
-            mass=self._mass)
+        key = Key(
+            str(channel), str(category), str(process), str(self._analysis),
+            str(self._epoch), str(self._variable), str(self._mass))
+        hist_hash = _key_format.format(**key._asdict())
         logger.debug("Try to access %s in %s" % (hist_hash,
                                                  self._rootfilename))
-        print "rootfile: " , self._rootfile.Get(hist_hash), " hash: ", hist_hash
+        if not key in self._get_index():
+            logger.warning("%s in %s does not exist!" %
+                           (hist_hash, self._rootfilename))
+            return None
+        hist = self._read(hist_hash)
+        logger.debug("Read %s from %s" % (hist_hash, self._rootfilename))
+        return hist
+
+    # Returns the Keys of all histograms in the file matching the given
+    # values, which may contain the wildcards of fnmatch, e.g.
+    # query(channel="mt", category="*_ggh", variable="m_vis").
+    def query(self, channel="*", category="*", process="*", analysis="*",
+              epoch="*", variable="*", mass="*"):
+        matchers = [
+            _matcher(pattern)
+            for pattern in [
+                channel, category, process, analysis, epoch, variable, mass
+            ]
+        ]
+        return [
+            key for key in self._get_index()
+            if all([match(value) for match, value in zip(matchers, key)])
+        ]
 
-        return self._rootfile.Get(hist_hash)
+    # returns the sorted values of a field of all keys matching the query,
+    # e.g. values("process", channel="mt", category="inclusive") or
+    # values("variable")
+    def values(self, field, **patterns):
+        if not field in Key._fields:
+            logger.fatal("Unknown field %s of the keys!" % field)
+            raise Exception
+        return sorted(
+            set([getattr(key, field) for key in self.query(**patterns)]))
 
     def list_contents(self):
         return [key.GetTitle() for key in self._rootfile.GetListOfKeys()]
@@ -57,5 +147,5 @@ class Rootfile_parser(object):
         return values
 
     def __del__(self):
-        logger.debug("Closing rootfile %s" % (self._rootfilename))
-        self._rootfile.Close()
+        logger.debug("Releasing rootfile %s" % (self._rootfilename))
+        self._pool.release(self._rootfilename, "READ")
@@ -4,17 +4,27 @@
 import logging
 import ROOT
 import copy
+import tfile_pool
+import hist_cache
+import profiling
+import hist_arrays
+import numpy as np
 logger = logging.getLogger(__name__)
 
 
 class ScaleFactor_Rootfile_parser(object):
-    def __init__(self, inputrootfilename):
+    def __init__(self, inputrootfilename, cache=None):
         self._rootfilename = inputrootfilename
-        self._rootfile = ROOT.TFile(self._rootfilename, "READ")
+        self._pool = tfile_pool.get_pool()
+        self._rootfile = self._pool.acquire(self._rootfilename, "READ")
+        # optional hist_cache.HistogramCache shared between parsers
+        self._cache = cache
+        self._file_id = hist_cache.file_id(inputrootfilename) if cache != None else None
         content = [entry.GetName() for entry in self._rootfile.GetListOfKeys()]
         self.Nbins = len(content)
         logger.debug("Identified {} histograms in rootfile {} ".format(len(content), inputrootfilename))
         self._hist_hash = "{variable}_projx_{etabin}"
+        self._keys = content
 
     @property
     def rootfile(self):
@@ -22,48 +32,131 @@ class ScaleFactor_Rootfile_parser(object):
 
 
 
+    @profiling.timed("read")
     def get(self, variable, etabin):
         hist_hash = self._hist_hash.format(
             variable=variable,
             etabin=etabin)
         logger.debug(
             "Try to access %s in %s" % (hist_hash, self._rootfilename))
-        return self._rootfile.Get(hist_hash)
+        if self._cache == None:
+            return self._rootfile.Get(hist_hash)
+        return self._cache.get((self._file_id, hist_hash),
+                               lambda: self._rootfile.Get(hist_hash))
 
 
+    # returns edges, contents, sumw2 and lower/upper errors as numpy arrays
+    def get_arrays(self, variable, etabin, flow=False):
+        return hist_arrays.get_arrays(self.get(variable, etabin), flow)
+
     def get_bins(self, variable, etabin):
-        hist = self.get(self, variable, etabin)
-        nbins = hist.GetNbinsX()
-        bins = []
-        for i in range(nbins):
-            bins.append(hist.GetBinLowEdge(i + 1))
-        bins.append(hist.GetBinLowEdge(i + 1) + hist.GetBinWidth(i + 1))
-        return bins
+        return self.get_arrays(variable, etabin).edges.tolist()
 
     def get_values(self, variable, etabin):
-        hist = self.get(self, variable, etabin)
-        nbins = hist.GetNbinsX()
-        values = []
-        for i in range(nbins):
-            values.append(hist.GetBinContent(i + 1))
-        return values
+        return self.get_arrays(variable, etabin).contents.tolist()
 
     def get_values_up(self, variable, etabin):
-        hist = self.get(self, variable, etabin)
-        nbins=hist.GetNbinsX()
-        values=[]
-        for i in range(nbins):
-            values.append(hist.GetBinErrDown(i + 1))
-        return values
+        return self.get_arrays(variable, etabin).errors_up.tolist()
 
     def get_values_down(self, variable, etabin):
-        hist = self.get(self, variable, etabin)
-        nbins = hist.GetNbinsX()
+        return self.get_arrays(variable, etabin).errors_down.tolist()
+
+    # returns the eta bin labels of the projections of a variable found in
+    # the file, sorted numerically if possible
+    def get_etabins(self, variable):
+        prefix = self._hist_hash.format(variable=variable, etabin="")
+        etabins = [
+            name[len(prefix):]
+            for name in self._keys if name.startswith(prefix)
+        ]
+        if all([etabin.isdigit() for etabin in etabins]):
+            return sorted(etabins, key=int)
+        return sorted(etabins)
+
+    # Reads the projections of all eta bins of a variable into a
+    # ScaleFactorTable. The eta bin edges are taken from eta_edges or, if
+    # not given, from the y axis of the 2D histogram of the variable. The eta
+    # bin labels default to all projections found in the file.
+    def load_table(self, variable, eta_edges=None, etabins=None):
+        if etabins is None:
+            etabins = self.get_etabins(variable)
+        if len(etabins) == 0:
+            logger.fatal("No projections of %s found in %s!" %
+                         (variable, self._rootfilename))
+            raise Exception
+        if eta_edges is None:
+            hist2d = self._rootfile.Get(variable)
+            if not (hist2d and hist2d.InheritsFrom("TH2")):
+                logger.fatal(
+                    "Eta bin edges of %s must be given, no 2D histogram found in %s!"
+                    % (variable, self._rootfilename))
+                raise Exception
+            axis = hist2d.GetYaxis()
+            eta_edges = [
+                axis.GetBinLowEdge(i + 1) for i in range(axis.GetNbins() + 1)
+            ]
+        if len(eta_edges) != len(etabins) + 1:
+            logger.fatal("Got %d eta bin edges for %d eta bins of %s!" %
+                         (len(eta_edges), len(etabins), variable))
+            raise Exception
+        pt_edges = None
         values = []
-        for i in range(nbins):
-            values.append(hist.GetBinErrDown(i + 1))
-        return values
+        errors_down = []
+        errors_up = []
+        for etabin in etabins:
+            arrays = self.get_arrays(variable, etabin)
+            if pt_edges is None:
+                pt_edges = arrays.edges
+            elif not np.array_equal(pt_edges, arrays.edges):
+                logger.fatal("Projections of %s have different binnings!" %
+                             variable)
+                raise Exception
+            values.append(arrays.contents)
+            errors_down.append(arrays.errors_down)
+            errors_up.append(arrays.errors_up)
+        return ScaleFactorTable(eta_edges, pt_edges, values, errors_down,
+                                errors_up)
 
     def __del__(self):
-        logger.debug("Closing rootfile %s" % (self._rootfilename))
-        self._rootfile.Close()
+        logger.debug("Releasing rootfile %s" % (self._rootfilename))
+        self._pool.release(self._rootfilename, "READ")
+
+
+# Scale factors with errors in bins of eta (rows) and pt (columns), which are
+# evaluated for arrays of events at once. Values outside of the binning are
+# clamped to the first or last bin.
+class ScaleFactorTable(object):
+    def __init__(self, eta_edges, pt_edges, values, errors_down, errors_up):
+        self.eta_edges = np.asarray(eta_edges, dtype=np.float64)
+        self.pt_edges = np.asarray(pt_edges, dtype=np.float64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.errors_down = np.asarray(errors_down, dtype=np.float64)
+        self.errors_up = np.asarray(errors_up, dtype=np.float64)
+        shape = (len(self.eta_edges) - 1, len(self.pt_edges) - 1)
+        for table in [self.values, self.errors_down, self.errors_up]:
+            if table.shape != shape:
+                logger.fatal(
+                    "Scale factor table has shape %s, expected %s from the bin edges!"
+                    % (table.shape, shape))
+                raise Exception
+
+    # bin indices of the values, clamped to the valid bins
+    def _find_bins(self, edges, x):
+        indices = np.searchsorted(edges, x, side="right") - 1
+        return np.clip(indices, 0, len(edges) - 2)
+
+    # returns the scale factors of the events, variation is "nominal", "up"
+    # or "down"
+    def evaluate(self, pt, eta, variation="nominal"):
+        pt = np.asarray(pt, dtype=np.float64)
+        eta = np.asarray(eta, dtype=np.float64)
+        indices = (self._find_bins(self.eta_edges, eta),
+                   self._find_bins(self.pt_edges, pt))
+        if variation == "nominal":
+            return self.values[indices]
+        elif variation == "up":
+            return self.values[indices] + self.errors_up[indices]
+        elif variation == "down":
+            return self.values[indices] - self.errors_down[indices]
+        logger.fatal("Unknown scale factor variation %s!" % variation)
+        raise Exception
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import json
+import numpy as np
+import hist_arrays
+logger = logging.getLogger(__name__)
+
+# The sidecar of a shapes file is a directory holding an index.json and a raw
+# float64 array file. Each histogram is stored as one block of edges
+# (nbins + 1) followed by contents, sumw2, lower and upper errors including
+# under- and overflow (nbins + 2 each). The index maps the histogram path to
+# the offset and number of bins of its block.
+_version = 1
+_index_name = "index.json"
+_arrays_name = "arrays.bin"
+
+
+def default_path(inputrootfilename):
+    return inputrootfilename + ".sidecar"
+
+
+# walks a shapes file once with the Rootfile_parser key index and writes all
+# TH1s to a sidecar, requires ROOT. Each histogram is freed after its arrays
+# are written, so that the memory does not grow with the size of the file.
+def convert(inputrootfilename, outputpath=None, mode="CombineHarvester"):
+    import ROOT
+    import rootfile_parser
+    if outputpath == None:
+        outputpath = default_path(inputrootfilename)
+    if not os.path.exists(outputpath):
+        os.makedirs(outputpath)
+    parser = rootfile_parser.Rootfile_parser(inputrootfilename, mode)
+    histograms = {}
+    offset = 0
+    with open(os.path.join(outputpath, _arrays_name), "wb") as arrays_file:
+        for directory in parser._get_keys(""):
+            for name in parser._get_keys(directory):
+                hist_hash = "{}/{}".format(directory, name)
+                hist = parser.rootfile.Get(hist_hash)
+                if hist and hist.InheritsFrom("TH1"):
+                    hist.SetDirectory(0)  # deleted with the proxy
+                    ROOT.SetOwnership(hist, True)
+                if not (hist and hist.InheritsFrom("TH1")
+                        and hist.GetDimension() == 1):
+                    logger.debug("Skip %s, which is no TH1" % hist_hash)
+                    continue
+                arrays = hist_arrays.get_arrays(hist, flow=True)
+                del hist
+                for array in arrays:
+                    arrays_file.write(array.astype(np.float64).tobytes())
+                nbins = len(arrays.edges) - 1
+                histograms[hist_hash] = [offset, nbins]
+                offset += (nbins + 1) + 4 * (nbins + 2)
+    index = {
+        "version": _version,
+        "source": os.path.abspath(inputrootfilename),
+        "source_mtime": os.path.getmtime(inputrootfilename),
+        "type": parser._type,
+        "hist_hash": parser._resolved_hash,
+        "histograms": histograms
+    }
+    with open(os.path.join(outputpath, _index_name), "w") as index_file:
+        json.dump(index, index_file)
+    logger.info("Converted %d histograms of %s to %s" %
+                (len(histograms), inputrootfilename, outputpath))
+    return outputpath
+
+
+# ROOT-free reader of a sidecar with the array interface of Rootfile_parser.
+# The arrays file is memory-mapped, so only the blocks of the requested
+# histograms are read from disk. Returned arrays are read-only views.
+class Sidecar_parser(object):
+    def __init__(self, sidecarpath):
+        self._sidecarpath = sidecarpath
+        with open(os.path.join(sidecarpath, _index_name)) as index_file:
+            index = json.load(index_file)
+        if index["version"] != _version:
+            logger.fatal("Sidecar %s has version %s, expected %s!" %
+                         (sidecarpath, index["version"], _version))
+            raise Exception
+        self._source = index["source"]
+        self._source_mtime = index["source_mtime"]
+        self._type = index["type"]
+        self._resolved_hash = index["hist_hash"]
+        self._histograms = index["histograms"]
+        self._keys = {}
+        for hist_hash in sorted(self._histograms.keys()):
+            directory, name = hist_hash.split('/')
+            self._keys.setdefault(directory, []).append(name)
+        if len(self._histograms) != 0:
+            self._arrays = np.memmap(
+                os.path.join(sidecarpath, _arrays_name),
+                dtype=np.float64,
+                mode="r")
+        else:  # empty files cannot be memory-mapped
+            self._arrays = np.zeros(0)
+        logger.debug("Opened sidecar %s with %d histograms of %s shapes" %
+                     (sidecarpath, len(self._histograms), self._type))
+
+    @property
+    def source(self):
+        return self._source
+
+    # checks whether the shapes file was modified after the conversion
+    def is_stale(self):
+        if not os.path.exists(self._source):
+            return False
+        return os.path.getmtime(self._source) != self._source_mtime
+
+    def list_histograms(self):
+        return sorted(self._histograms.keys())
+
+    def _format_hash(self, era, channel, category, process, syst=None):
+        if syst != None and self._type != "control":
+            logger.fatal(
+                "Uncertainty shapes are only available in control plots!")
+            raise Exception
+        return self._resolved_hash.format(
+            era=era,
+            channel=channel,
+            category=category,
+            process=process,
+            unc="" if syst == None else "_" + syst)
+
+    def _read(self, hist_hash, flow):
+        offset, nbins = self._histograms[hist_hash]
+        blocks = [nbins + 1] + 4 * [nbins + 2]
+        arrays = []
+        for size in blocks:
+            arrays.append(self._arrays[offset:offset + size])
+            offset += size
+        if not flow:
+            arrays = [arrays[0]] + [array[1:-1] for array in arrays[1:]]
+        return hist_arrays.HistArrays(*arrays)
+
+    def get_arrays(self, era, channel, category, process, syst=None, flow=False):
+        hist_hash = self._format_hash(era, channel, category, process, syst)
+        if hist_hash in self._histograms:
+            return self._read(hist_hash, flow)
+        directory = hist_hash.split('/')[0]
+        available_processes = self._keys.get(directory, [])
+        if len(available_processes) == 0:
+            logger.fatal(" None of the requested Histograms are available in %s. Aborting." % directory)
+            raise Exception
+        logger.warning("%s in %s does not exist !" % (hist_hash, self._sidecarpath))
+        logger.debug(" Returning empty arrays ")
+        arrays = self._read('{}/{}'.format(directory, available_processes[0]), flow)
+        return hist_arrays.HistArrays(
+            arrays.edges, *[np.zeros_like(array) for array in arrays[1:]])
+
+    def get_bins(self, era, channel, category, process, syst=None):
+        return self.get_arrays(era, channel, category, process,
+                               syst).edges.tolist()
+
+    def get_values(self, era, channel, category, process, syst=None):
+        return self.get_arrays(era, channel, category, process,
+                               syst).contents.tolist()
+
+    def get_values_up(self, era, channel, category, process, syst=None):
+        return self.get_arrays(era, channel, category, process,
+                               syst).errors_up.tolist()
+
+    def get_values_down(self, era, channel, category, process, syst=None):
+        return self.get_arrays(era, channel, category, process,
+                               syst).errors_down.tolist()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Convert a shapes file to a ROOT-free sidecar.")
+    parser.add_argument("input", type=str, help="Shapes file to convert.")
+    parser.add_argument(
+        "--output",
+        default=None,
+        type=str,
+        help="Output directory, defaults to <input>.sidecar.")
+    parser.add_argument(
+        "--mode",
+        default="CombineHarvester",
+        choices=["CombineHarvester", "standard"],
+        help="Naming scheme of the shapes file.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_arguments()
+    convert(args.input, args.output, args.mode)
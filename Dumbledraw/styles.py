@@ -1,5 +1,6 @@
 import ROOT as R
 import logging
+import fnmatch
 import yaml
 logger = logging.getLogger(__name__)
 
@@ -69,6 +70,77 @@ color_dict = {
     "unc": CreateTransparentColor(12, 0.4)
 }
 
+# arguments of setGraphStyle which can be set by style sheets
+style_arguments = [
+    "markerstyle", "markershape", "markercolor", "linecolor", "fillcolor",
+    "linewidth", "markersize", "linestyle", "fillstyle", "alpha"
+]
+
+
+# Declarative graph styles, set with plot.setStyleSheet(sheet). Rules set
+# arguments of setGraphStyle for the histograms and graphs selected by name,
+# group name or fnmatch pattern of the name. The arguments of the defaults
+# and all matching rules are combined, where name rules override pattern
+# rules, which override group rules, and later rules of the same kind
+# override earlier ones. Objects without resolved markerstyle are not
+# styled. Styles are resolved once per name and group for all plots using
+# the sheet and only applied to drawn objects which have no style set by
+# setGraphStyle.
+class StyleSheet(object):
+    def __init__(self, **defaults):
+        self._check(defaults)
+        self._defaults = defaults
+        self._rules = {"group": [], "pattern": [], "name": []}
+        self._resolved = {}  # (name, group) -> style or None
+
+    def _check(self, style):
+        for argument in style:
+            if not argument in style_arguments:
+                logger.fatal("Unknown style argument %s!" % argument)
+                raise Exception
+
+    def add_rule(self, name=None, group=None, pattern=None, **style):
+        selectors = [(kind, value)
+                     for kind, value in [("name", name), ("group", group),
+                                         ("pattern", pattern)]
+                     if value != None]
+        if len(selectors) != 1:
+            logger.fatal(
+                "A style rule needs exactly one of name, group or pattern!")
+            raise Exception
+        self._check(style)
+        kind, value = selectors[0]
+        self._rules[kind].append((value, style))
+        self._resolved = {}
+        return self
+
+    # adds name rules for all processes of color_dict, setting their color
+    # as the given attribute, e.g. fillcolor for stacked backgrounds
+    def add_color_rules(self, markerstyle="hist", attribute="fillcolor",
+                        **style):
+        for name, color in color_dict.items():
+            rule = dict(style)
+            rule[attribute] = color
+            self.add_rule(name=name, markerstyle=markerstyle, **rule)
+        return self
+
+    # returns the setGraphStyle arguments of an object or None
+    def resolve(self, name, group):
+        key = (name, group)
+        if not key in self._resolved:
+            style = dict(self._defaults)
+            for rule_group, rule_style in self._rules["group"]:
+                if rule_group == group:
+                    style.update(rule_style)
+            for pattern, rule_style in self._rules["pattern"]:
+                if fnmatch.fnmatchcase(name, pattern):
+                    style.update(rule_style)
+            for rule_name, rule_style in self._rules["name"]:
+                if rule_name == name:
+                    style.update(rule_style)
+            self._resolved[key] = style if "markerstyle" in style else None
+        return self._resolved[key]
+
 
 def SetStyle(name, **kwargs):
     styles = {"none": none, "TDR": SetTDRStyle, "ModTDR": ModTDRStyle}
@@ -311,12 +383,16 @@ def ModTDRStyle(width=600, height=600, t=0.06, b=0.12, l=0.16, r=0.04):
 
     R.TGaxis.SetExponentOffset(-0.07, 0.0, "y");
 
-def DrawText(pad, text, scale_text_size, pos, angle, custom_pos = None):
+# borders = [left, right, top, bottom] in NDC optionally replaces the frame of the pad as reference box
+def DrawText(pad, text, scale_text_size, pos, angle, custom_pos = None, borders = None):
     pad.cd()
-    left_border = pad.GetLeftMargin()
-    right_border = 1.0 - pad.GetRightMargin()
-    top_border = 1.0 - pad.GetTopMargin()
-    bottom_border = pad.GetBottomMargin()
+    if borders != None:
+        left_border, right_border, top_border, bottom_border = borders
+    else:
+        left_border = pad.GetLeftMargin()
+        right_border = 1.0 - pad.GetRightMargin()
+        top_border = 1.0 - pad.GetTopMargin()
+        bottom_border = pad.GetBottomMargin()
     
     x_pos = 0.0
     y_pos = 0.0
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import fnmatch
+import collections
+import numpy as np
+import ROOT as R
+import profiling
+logger = logging.getLogger(__name__)
+
+# bin edges, summed nominal contents and total lower/upper uncertainties of
+# the background sum as float64 arrays
+Band = collections.namedtuple(
+    "Band", ["edges", "nominal", "errors_down", "errors_up"])
+
+
+def _get_contents(parser, era, channel, category, process, syst, edges):
+    arrays = parser.get_arrays(era, channel, category, process, syst)
+    if edges is not None and not np.array_equal(arrays.edges, edges):
+        logger.fatal("Binning of %s %s differs from the nominal histogram!" %
+                     (process, syst))
+        raise Exception
+    return arrays
+
+
+# Computes the uncertainty band of the sum of the given processes from the
+# {process}_{syst}Up/Down shapes of a control shapes file read with
+# rootfile_parser.Rootfile_parser. All systematics with both variations are
+# used unless a list of names or fnmatch patterns is given as systs.
+# Variations of the same systematic are treated as correlated between the
+# processes, processes without a variation are taken as unchanged. The shifts
+# of the systematics are added in quadrature, using per bin the larger
+# upwards and downwards shift or with symmetrize=True the mean absolute
+# shift for both directions. With mc_stat=True the statistical uncertainty
+# from the sum of squared weights is added in quadrature.
+@profiling.timed("syst_band")
+def compute(parser,
+            era,
+            channel,
+            category,
+            processes,
+            systs=None,
+            mc_stat=True,
+            symmetrize=False):
+    if isinstance(processes, basestring):
+        processes = [processes]
+    variations = parser.get_variations(era, channel, category, processes)
+    names = sorted(
+        set([syst for process in processes for syst in variations[process]]))
+    if systs != None:
+        if isinstance(systs, basestring):
+            systs = [systs]
+        names = [
+            name for name in names
+            if any([fnmatch.fnmatchcase(name, pattern) for pattern in systs])
+        ]
+    logger.debug("Use %d systematics for the band of %s" %
+                 (len(names), ", ".join(processes)))
+
+    # shifts of the summed contents, [up, down] x systematics x bins
+    edges = None
+    nominal = None
+    for process in processes:
+        arrays = _get_contents(parser, era, channel, category, process, None,
+                               edges)
+        if edges is None:
+            edges = arrays.edges
+            nominal = np.zeros(len(edges) - 1)
+            sumw2 = np.zeros(len(edges) - 1)
+            shifts = np.zeros((2, len(names), len(edges) - 1))
+        nominal += arrays.contents
+        sumw2 += arrays.sumw2
+        available = set(variations[process])
+        for j, name in enumerate(names):
+            if not name in available:
+                continue
+            for k, shift in enumerate(["Up", "Down"]):
+                shifts[k, j] += _get_contents(parser, era, channel, category,
+                                              process, name + shift,
+                                              edges).contents
+                shifts[k, j] -= arrays.contents
+    if edges is None:
+        logger.fatal("No processes given for the uncertainty band!")
+        raise Exception
+
+    if symmetrize:
+        squares = np.sum((0.5 * np.abs(shifts).sum(axis=0))**2, axis=0)
+        squares_up = squares
+        squares_down = squares
+    else:
+        squares_up = np.sum(np.maximum(shifts.max(axis=0), 0.0)**2, axis=0)
+        squares_down = np.sum(np.minimum(shifts.min(axis=0), 0.0)**2, axis=0)
+    if mc_stat:
+        squares_up = squares_up + sumw2
+        squares_down = squares_down + sumw2
+    return Band(edges, nominal, np.sqrt(squares_down), np.sqrt(squares_up))
+
+
+# returns the band as TGraphAsymmErrors with points at the bin centers, e.g.
+# for plot.add_graph(to_graph(band), "unc") with the "e2" style
+def to_graph(band, name="band"):
+    centers = 0.5 * (band.edges[1:] + band.edges[:-1])
+    half_widths = 0.5 * np.diff(band.edges)
+    graph = R.TGraphAsymmErrors(
+        len(centers), np.ascontiguousarray(centers),
+        np.ascontiguousarray(band.nominal), np.ascontiguousarray(half_widths),
+        np.ascontiguousarray(half_widths),
+        np.ascontiguousarray(band.errors_down),
+        np.ascontiguousarray(band.errors_up))
+    graph.SetName(name)
+    return graph
+
+
+# returns the band as TH1D for plot.add_hist(to_hist(band), "unc") with the
+# "e2" style. Since histograms only have symmetric errors, the bin contents
+# are moved to the center of asymmetric bands, so that the drawn boxes cover
+# the same range as the band.
+def to_hist(band, name="band"):
+    hist = R.TH1D(name, "", len(band.edges) - 1,
+                  np.ascontiguousarray(band.edges))
+    hist.SetDirectory(0)
+    centers = band.nominal + 0.5 * (band.errors_up - band.errors_down)
+    widths = 0.5 * (band.errors_up + band.errors_down)
+    for i in xrange(len(centers)):
+        hist.SetBinContent(i + 1, centers[i])
+        hist.SetBinError(i + 1, widths[i])
+    return hist
+
+
+# band of the ratio to the nominal sum for ratio subplots, bins with empty
+# nominal sum get a band of zero width around one
+def relative(band):
+    nominal = np.where(band.nominal != 0.0, band.nominal, 1.0)
+    empty = band.nominal == 0.0
+    return Band(band.edges, np.ones(len(nominal)),
+                np.where(empty, 0.0, band.errors_down / nominal),
+                np.where(empty, 0.0, band.errors_up / nominal))
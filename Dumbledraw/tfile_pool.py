@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import collections
+import ROOT
+logger = logging.getLogger(__name__)
+
+
+# Process-wide pool of open TFiles keyed by path and open mode. Files are
+# reference counted so that parsers reading the same file share one handle.
+# Files which are no longer used stay open for reuse until the number of open
+# handles exceeds max_open, then the least recently used ones are closed.
+class TFilePool(object):
+    def __init__(self, max_open=32):
+        self._max_open = max_open
+        self._files = collections.OrderedDict()  # key -> [tfile, refcount]
+        self._closed_bytes = 0  # bytes read from files closed by the pool
+        self._lock = threading.RLock()
+
+    @property
+    def max_open(self):
+        return self._max_open
+
+    @property
+    def nopen(self):
+        return len(self._files)
+
+    # bytes read from all files opened by the pool, including closed ones
+    def bytes_read(self):
+        with self._lock:
+            return self._closed_bytes + sum(
+                [entry[0].GetBytesRead() for entry in self._files.values()])
+
+    def _key(self, filename, mode):
+        return (os.path.abspath(filename), mode.upper())
+
+    def set_max_open(self, max_open):
+        if not isinstance(max_open, int) or max_open < 1:
+            logger.fatal("Maximum number of open files must be a positive int!")
+            raise Exception
+        with self._lock:
+            self._max_open = max_open
+            self._evict()
+
+    def acquire(self, filename, mode="READ"):
+        key = self._key(filename, mode)
+        with self._lock:
+            if key in self._files:
+                entry = self._files.pop(key)
+                entry[1] += 1
+                self._files[key] = entry  # mark as most recently used
+                logger.debug("Reuse open rootfile %s" % filename)
+                return entry[0]
+            logger.debug("Open rootfile %s in mode %s" % (filename, key[1]))
+            tfile = ROOT.TFile(filename, mode)
+            if not tfile or tfile.IsZombie():
+                logger.fatal("Cannot open rootfile %s!" % filename)
+                raise Exception
+            self._files[key] = [tfile, 1]
+            self._evict()
+            return tfile
+
+    def release(self, filename, mode="READ"):
+        key = self._key(filename, mode)
+        with self._lock:
+            if not key in self._files:
+                logger.warning("Rootfile %s released but not in pool!" % filename)
+                return
+            self._files[key][1] -= 1
+            self._evict()
+
+    # closes least recently used files without users until the cap is met
+    def _evict(self):
+        for key in list(self._files.keys()):
+            if len(self._files) <= self._max_open:
+                break
+            if self._files[key][1] <= 0:
+                self._close(key)
+        if len(self._files) > self._max_open:
+            logger.debug("%d rootfiles in use, exceeding the pool size of %d"
+                         % (len(self._files), self._max_open))
+
+    # closes all files without users
+    def close_unused(self):
+        with self._lock:
+            for key in list(self._files.keys()):
+                if self._files[key][1] <= 0:
+                    self._close(key)
+
+    def _close(self, key):
+        logger.debug("Closing rootfile %s" % key[0])
+        tfile = self._files.pop(key)[0]
+        self._closed_bytes += tfile.GetBytesRead()
+        tfile.Close()
+
+
+_pool = TFilePool()
+_local = threading.local()  # private pools of threads
+
+
+# Makes the calling thread open its own TFile handles instead of sharing
+# those of the process-wide pool, e.g. a thread reading histograms in
+# parallel to the main thread. Parsers keep the pool they were created with.
+def use_private_pool(max_open=None):
+    _local.pool = TFilePool(_pool.max_open if max_open == None else max_open)
+    return _local.pool
+
+
+# returns the pool of the calling thread
+def get_pool():
+    return getattr(_local, "pool", _pool)
+
+
+def acquire(filename, mode="READ"):
+    return get_pool().acquire(filename, mode)
+
+
+def release(filename, mode="READ"):
+    get_pool().release(filename, mode)
+
+
+def set_max_open(max_open):
+    get_pool().set_max_open(max_open)
@@ -4,9 +4,12 @@
 import Dumbledraw.dumbledraw as dd
 import Dumbledraw.rootfile_parser_inputshapes as rootfile_parser
 import Dumbledraw.styles as styles
+import Dumbledraw.campaign as campaign
+import Dumbledraw.profiling as profiling
 import ROOT as R
 
 import argparse
+import threading
 from copy import deepcopy
 
 from root_numpy import hist2array
@@ -49,130 +52,269 @@ def parse_arguments():
         nargs='+',
         type=str,
         help="Variables to be considered.")
+    parser.add_argument(
+        "--shapes",
+        default="2016_shapes.root",
+        type=str,
+        help="Input shapes file.")
+    parser.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help="Number of parallel worker processes.")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip plots whose inputs and settings did not change.")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report which plots would be rebuilt in incremental mode.")
+    parser.add_argument(
+        "--backend",
+        default="root",
+        choices=["root", "matplotlib"],
+        help="Backend used to render the plots.")
+    parser.add_argument(
+        "--profile",
+        default=None,
+        type=str,
+        help="Profile the campaign and write the timeline to this Chrome trace file.")
+    parser.add_argument(
+        "--prefetch",
+        default=0,
+        type=int,
+        help="Number of plots whose histograms are read ahead in a background thread.")
     return parser.parse_args()
 
 #xlabels = { "pt": r'Reconstructed p_{T}^{H} (GeV)', "eta":r'Reconstructed #eta',"phi": r' Reconstructed #phi',"m":r'Reconstructed mass m_{H} (GeV)'}
 
-def main(args):
-	hack = []
-	roc = {}
-	shapes = {}
-	for channel in args.channels:
-		roc[channel] = {}
-		shapes[channel] = {}
-		for category in args.categories:
-			roc[channel][category] = {}
-			shapes[channel][category] = {}
-	for variable in args.variables:
-		for channel in args.channels:
-			for category in args.categories:
-				rootfile = rootfile_parser.Rootfile_parser("2016_shapes.root", "smhtt", "Run2016", variable, 125)
-				#print rootfile.list_contents()
-				name = "_".join([channel, category])
-				out_name = "_".join([channel, category, variable])
-				print name	
-	
-				# create canvas:
-				#   First argument defines subplot structure: List of splits from top to bottom (max. 1.0 to min. 0.0). A split can be a single position or a pair resulting in gap.
-				#   Further arguments set general style.
-				plot = dd.Plot(
-					[0.05], "ModTDR", r=0.04, l=0.14)
-	
-				#bkg_processes = ["EWK", "QCD", "VV", "W", "TTT", "TTJ", "ZJ", "ZL", "ZTT"]
-				bkg_processes = ["EWK", "QCD", "VV", "W", "TTT", "TTJ", "ZL", "ZJ", "ZTT"]
-				if channel == 'tt':
-					bkg_processes = ["QCD", "VVT", "VVJ", "W", "TTT", "TTJ", "ZL", "ZJ", "ZTT"]
-	
-				# register histograms in the subplots (can be done globally or for specific subplots). regustered histograms are not necessarily plotted later.
-				for process in bkg_processes:
-					plot.add_hist(
-						rootfile.get(channel, name, process), process, "bkg"
-					)  # get(channel, category, process) and assign specific name and group name to histogram. The group name is optional.
-					plot.setGraphStyle(
-						process, "hist", fillcolor=styles.color_dict[process])
-
-#				for i in range(1):
-#					plot.add_hist(
-#						rootfile.get(channel, name, "ggh"), "ggh"
-#						)  # signal histograms are used twice in order to realize a two color line style
-#					plot.add_hist(
-#						rootfile.get(channel, name, "ggh"), "ggh_top")
-#					plot.add_hist(rootfile.get(channel, name, "qqH"), "qqH")
-#					plot.add_hist(
-#						rootfile.get(channel, name, "qqH"), "qqH_top")
-				plot.add_hist(rootfile.get(channel, name, "data_obs"), "data_obs", "data_obs")
-				# set some graph styles
-#				plot.setGraphStyle(
-#					"ggh", "hist", linecolor=styles.color_dict["ggh"], linewidth=3)
-#				plot.setGraphStyle("ggh_top", "hist", linecolor=0)
-#				plot.setGraphStyle(
-#					"qqH", "hist", linecolor=styles.color_dict["qqH"], linewidth=3)
-
-#				plot.setGraphStyle("qqH_top", "hist", linecolor=0)
-				plot.setGraphStyle(
-					"data_obs",
-					"e0",
-					markersize=1,
-					fillcolor=styles.color_dict["unc"],
-					linecolor=1)
-				plot.create_stack(bkg_processes, "stack")
-#				plot.subplot(1).normalize(["data_obs"], bkg_processes) # would also work but add up the single bkg histograms in the background
-				if channel == 'tt':
-					plot.subplot(0).setYlims(1, 1e5)
-					plot.DrawChannelCategoryLabel("#tau_{h}#tau_{h}")
-				elif channel == 'mt':
-					plot.subplot(0).setYlims(1, 1e7)
-					plot.DrawChannelCategoryLabel("#mu#tau_{h}")
-				elif channel == 'et':
-					plot.subplot(0).setYlims(0.1, 1e7)
-					plot.DrawChannelCategoryLabel("e#tau_{h}")
-
-	#			plot.subplot(0).setXlims(-200, 200)
-	#			plot.subplot(1).setXlims(-200, )
-				plot.subplot(1).setYlims(0, 2)
-				plot.subplot(0).setLogY()
-				plot.subplot(0).setXlabel(variable)
-				plot.subplot(0).setYlabel("N_{events}")
-				plot.subplot(1).setYlabel("ratio to bkg")
-	
-				plot.scaleXTitleSize(0.8)
-				plot.scaleXLabelSize(0.8)
-				plot.scaleYTitleSize(0.8)
-				plot.scaleYLabelSize(0.8)
-				plot.scaleXLabelOffset(2.0)
-				plot.scaleYTitleOffset(1.1)
-				plot.subplot(0).Draw(['stack', "data_obs", 
-										"ggh", "qqH", "ggh_top", "qqH_top", ])
-	#			plot.subplot(1).add_hist(R.TF1("line", "1", 0, 1000), "line")
-#				plot.subplot(1).Draw(["data_obs", "line"])
-	
-				# create legends
-				bkg_processes.reverse()
-				suffix = ["", "_top"]
-				for i in range(2):
-					plot.add_legend(width=0.5, height=0.08)
-					for process in bkg_processes:
-						plot.legend(i).add_entry(0, process,
-												 styles.legend_label_dict[process], 'f')
-					#plot.legend(i).add_entry(1, "ggh%s" % suffix[i], "ggh", 'l')
-					#plot.legend(i).add_entry(1, "qqH%s" % suffix[i], "qqH", 'l')
-#					plot.legend(i).add_entry(0, "data_obs", "Data", 'PE')
-					plot.legend(i).setNColumns(3)
-				plot.legend(0).Draw()
-				plot.subplot(1)._pad.SetGrid()
-	
-				# draw additional labels
-				plot.DrawCMS()
-				plot.DrawLumi("35.9 fb^{-1} (13 TeV)")
-	
-				# save plot
-				plot.save(out_name + ".png")
-				plot.save(out_name + ".pdf")
-				hack.append(plot)
+# per worker state: shapes file name, one parser per thread and variable,
+# sharing the same open file via the TFile pool of the thread, and one plot
+# template per channel
+_shapes_file = None
+_incremental = False
+_dry_run = False
+_backend = "root"
+_parsers = threading.local()
+_templates = {}
+
+# graph styles of all plots, resolved once per histogram name and applied to
+# the drawn histograms
+style_sheet = styles.StyleSheet()
+style_sheet.add_color_rules("hist")
+style_sheet.add_rule(
+    name="data_obs",
+    markerstyle="e0",
+    markersize=1,
+    fillcolor=styles.color_dict["unc"],
+    linecolor=1)
+
+
+def setup_worker(shapes_file, incremental=False, dry_run=False,
+                 backend="root"):
+    global _shapes_file, _incremental, _dry_run, _backend
+    _shapes_file = shapes_file
+    _incremental = incremental
+    _dry_run = dry_run
+    _backend = backend
+    R.gROOT.SetBatch(True)
+    styles.SetStyle("ModTDR", r=0.04, l=0.14)
+
+
+def get_parser(variable):
+    if not hasattr(_parsers, "parsers"):
+        _parsers.parsers = {}
+    if not variable in _parsers.parsers:
+        _parsers.parsers[variable] = rootfile_parser.Rootfile_parser(
+            _shapes_file, "smhtt", "Run2016", variable, 125)
+    return _parsers.parsers[variable]
+
+
+def get_bkg_processes(channel):
+    #bkg_processes = ["EWK", "QCD", "VV", "W", "TTT", "TTJ", "ZJ", "ZL", "ZTT"]
+    bkg_processes = ["EWK", "QCD", "VV", "W", "TTT", "TTJ", "ZL", "ZJ", "ZTT"]
+    if channel == 'tt':
+        bkg_processes = ["QCD", "VVT", "VVJ", "W", "TTT", "TTJ", "ZL", "ZJ", "ZTT"]
+    return bkg_processes
+
+
+# Returns the plot template of a channel. Canvas, subplots, axis settings and
+# legends are set up once per worker and channel, the histograms are
+# replaced for each plot.
+def get_template(channel):
+    if channel in _templates:
+        plot = _templates[channel]
+        plot.clear_hists()
+        return plot
+
+    # create canvas:
+    #   First argument defines subplot structure: List of splits from top to bottom (max. 1.0 to min. 0.0). A split can be a single position or a pair resulting in gap.
+    #   Further arguments set general style.
+    plot = dd.Plot(
+        [0.05], "ModTDR", backend=_backend, r=0.04, l=0.14)
+    plot.setStyleSheet(style_sheet)
 
+    if channel == 'tt':
+        plot.subplot(0).setYlims(1, 1e5)
+    elif channel == 'mt':
+        plot.subplot(0).setYlims(1, 1e7)
+    elif channel == 'et':
+        plot.subplot(0).setYlims(0.1, 1e7)
+
+    #plot.subplot(0).setXlims(-200, 200)
+    #plot.subplot(1).setXlims(-200, )
+    plot.subplot(1).setYlims(0, 2)
+    plot.subplot(0).setLogY()
+    plot.subplot(0).setYlabel("N_{events}")
+    plot.subplot(1).setYlabel("ratio to bkg")
+
+    plot.scaleXTitleSize(0.8)
+    plot.scaleXLabelSize(0.8)
+    plot.scaleYTitleSize(0.8)
+    plot.scaleYLabelSize(0.8)
+    plot.scaleXLabelOffset(2.0)
+    plot.scaleYTitleOffset(1.1)
+    if _backend == "root":
+        plot.subplot(1)._pad.SetGrid()
+    else:
+        plot.subplot(1).setGrid()
+
+    # create legends, the entries are bound to the histograms of each plot when drawn
+    for i in range(2):
+        plot.add_legend(width=0.5, height=0.08)
+        plot.legend(i).setNColumns(3)
+    _templates[channel] = plot
+    return plot
+
+
+# releases the plot templates of this process
+def close_templates():
+    for plot in _templates.values():
+        plot.close()
+    _templates.clear()
+
+
+# reads the histograms of a plot, also called ahead of the plot in the
+# prefetch thread of the campaign
+def read_inputs(task):
+    variable, channel, category = task
+    rootfile = get_parser(variable)
+    #print rootfile.list_contents()
+    name = "_".join([channel, category])
+    hists = {}
+    for process in get_bkg_processes(channel) + ["data_obs"]:
+        hists[process] = rootfile.get(channel, name, process)
+    return hists
+
+
+def plot_single(task, hists=None):
+    variable, channel, category = task
+    if hists == None:
+        hists = read_inputs(task)
+    name = "_".join([channel, category])
+    out_name = "_".join([channel, category, variable])
+    print name
+
+    plot = get_template(channel)
+    bkg_processes = get_bkg_processes(channel)
+
+    # register histograms in the subplots (can be done globally or for specific subplots). regustered histograms are not necessarily plotted later.
+    for process in bkg_processes:
+        plot.add_hist(
+            hists[process], process, "bkg"
+        )  # get(channel, category, process) and assign specific name and group name to histogram. The group name is optional.
+
+    #for i in range(1):
+    #    plot.add_hist(
+    #        rootfile.get(channel, name, "ggh"), "ggh"
+    #        )  # signal histograms are used twice in order to realize a two color line style
+    #    plot.add_hist(
+    #        rootfile.get(channel, name, "ggh"), "ggh_top")
+    #    plot.add_hist(rootfile.get(channel, name, "qqH"), "qqH")
+    #    plot.add_hist(
+    #        rootfile.get(channel, name, "qqH"), "qqH_top")
+    plot.add_hist(hists["data_obs"], "data_obs", "data_obs")
+    # set some graph styles
+    #plot.setGraphStyle(
+    #    "ggh", "hist", linecolor=styles.color_dict["ggh"], linewidth=3)
+    #plot.setGraphStyle("ggh_top", "hist", linecolor=0)
+    #plot.setGraphStyle(
+    #    "qqH", "hist", linecolor=styles.color_dict["qqH"], linewidth=3)
+
+    #plot.setGraphStyle("qqH_top", "hist", linecolor=0)
+    # the styles of the background processes and data are set by style_sheet
+    plot.create_stack(bkg_processes, "stack")
+    #plot.subplot(1).normalize(["data_obs"], bkg_processes) # would also work but add up the single bkg histograms in the background
+    if channel == 'tt':
+        plot.DrawChannelCategoryLabel("#tau_{h}#tau_{h}")
+    elif channel == 'mt':
+        plot.DrawChannelCategoryLabel("#mu#tau_{h}")
+    elif channel == 'et':
+        plot.DrawChannelCategoryLabel("e#tau_{h}")
+    plot.subplot(0).setXlabel(variable)
+    plot.subplot(0).Draw(['stack', "data_obs",
+                          "ggh", "qqH", "ggh_top", "qqH_top", ])
+    #plot.subplot(1).add_hist(R.TF1("line", "1", 0, 1000), "line")
+    #plot.subplot(1).Draw(["data_obs", "line"])
+
+    # fill legends of a new template
+    if plot.legend(0).nentries == 0:
+        suffix = ["", "_top"]
+        for i in range(2):
+            for process in reversed(bkg_processes):
+                plot.legend(i).add_entry(0, process,
+                                         styles.legend_label_dict[process], 'f')
+            #plot.legend(i).add_entry(1, "ggh%s" % suffix[i], "ggh", 'l')
+            #plot.legend(i).add_entry(1, "qqH%s" % suffix[i], "qqH", 'l')
+            #plot.legend(i).add_entry(0, "data_obs", "Data", 'PE')
+    plot.legend(0).Draw()
+
+    # draw additional labels
+    plot.DrawCMS()
+    plot.DrawLumi("35.9 fb^{-1} (13 TeV)")
+
+    # save plot, returns whether the plot is (or would be) rebuilt
+    if _dry_run:
+        return plot.needs_update(out_name, formats=["png", "pdf"])
+    return plot.save(
+        out_name, formats=["png", "pdf"], incremental=_incremental)
+
+
+def main(args):
+    tasks = [(variable, channel, category)
+             for variable in args.variables
+             for channel in args.channels
+             for category in args.categories]
+    if args.profile != None:
+        profiling.enable()
+    results = campaign.run_campaign(
+        plot_single,
+        tasks,
+        args.jobs,
+        setup_worker,
+        (args.shapes, args.incremental, args.dry_run, args.backend),
+        prefetch=read_inputs if args.prefetch > 0 else None,
+        depth=max(args.prefetch, 1))
+    close_templates()
+    rebuilt = [result.task for result in results if result.value]
+    if args.dry_run:
+        logger.info("%d of %d plots would be rebuilt" % (len(rebuilt),
+                                                        len(results)))
+        for task in rebuilt:
+            logger.info("  rebuild: %s" % (task, ))
+    elif args.incremental:
+        logger.info("%d of %d plots rebuilt" % (len(rebuilt), len(results)))
+    if profiling.is_enabled():
+        profiling.log_summary()
+        profiling.log_summary(per_plot=True)
+        if args.profile != None:
+            profiling.write_trace(args.profile)
+    return campaign.log_summary(results)
 
 
 if __name__ == "__main__":
     args = parse_arguments()
     setup_logging("plot_shapes.log", logging.INFO)
-    main(args)
+    if not main(args):
+        exit(1)